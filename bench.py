@@ -0,0 +1,1018 @@
+"""Local benchmarks for the bot's hot database paths.
+
+Needs a throwaway Postgres: the schema is created with DB.init() and the bot tables are
+TRUNCATEd between runs, so this refuses to use DATABASE_URL and reads BENCH_DATABASE_URL.
+
+    BENCH_DATABASE_URL=postgresql://localhost/bench python bench.py purchase --purchases 5000
+"""
+import argparse
+import asyncio
+import os
+import resource
+import statistics
+import time
+import uuid
+from typing import Dict, List
+
+import aiohttp
+import asyncpg
+from aiohttp import web
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+from aiogram.methods import EditMessageText, SendMessage
+
+from bot import (
+    DB, MIGRATIONS, PRIO_DELIVERY, PRIO_REPLY, TIMEZONE, WEBHOOK_PATH, Broadcaster, Outbox, WebhookServer, build_dispatcher,
+    run_supervisor,
+)
+
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL", "").strip()
+BENCH_SKU = "BENCH"
+BENCH_TOKEN = "123456:BENCH"
+
+
+async def reset(pool: asyncpg.Pool, users: int, codes: int, price_cents: int = 100):
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "TRUNCATE balance_moves, orders, codes, codes_history, pending_codes, purchase_guards, broadcasts, topup_refs, "
+            "users, products RESTART IDENTITY CASCADE"
+        )
+        await conn.execute(
+            "INSERT INTO products(sku,name,price_cents,active) VALUES($1,$1,$2,TRUE)", BENCH_SKU, price_cents
+        )
+        await conn.copy_records_to_table(
+            "users",
+            records=[(i, f"bench{i}", "Bench", 10**9) for i in range(1, users + 1)],
+            columns=["telegram_id", "username", "first_name", "balance_cents"],
+        )
+        await conn.copy_records_to_table(
+            "codes",
+            records=[(BENCH_SKU, uuid.uuid4().hex, "available") for _ in range(codes)],
+            columns=["sku", "code", "status"],
+        )
+        await conn.execute("INSERT INTO product_stock(sku, available) VALUES($1,$2)", BENCH_SKU, codes)
+        await conn.execute("ANALYZE")
+
+
+async def legacy_deliver_purchase(pool: asyncpg.Pool, telegram_id: int, sku: str) -> bool:
+    # The pre-stored-function implementation, kept here as the baseline.
+    async with pool.acquire() as conn:
+        prod = await conn.fetchrow("SELECT name, price_cents, active FROM products WHERE sku=$1", sku)
+    if not prod or not prod["active"]:
+        return False
+    price_cents = int(prod["price_cents"])
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            u = await conn.fetchrow("SELECT balance_cents FROM users WHERE telegram_id=$1 FOR UPDATE", telegram_id)
+            if not u or int(u["balance_cents"]) < price_cents:
+                return False
+            balance = int(u["balance_cents"])
+            code_row = await conn.fetchrow("""
+                SELECT id, code FROM codes
+                WHERE sku=$1 AND status='available'
+                ORDER BY id ASC
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            """, sku)
+            if not code_row:
+                return False
+            order_id = uuid.uuid4().hex[:10].upper()
+            new_balance = balance - price_cents
+            await conn.execute("""
+                UPDATE codes
+                SET status='delivered', delivered_at=now(), buyer_telegram_id=$2, order_id=$3
+                WHERE id=$1
+            """, int(code_row["id"]), telegram_id, order_id)
+            await conn.execute("""
+                INSERT INTO orders(order_id, telegram_id, sku, price_cents, status, delivered_at)
+                VALUES($1,$2,$3,$4,'paid_delivered',now())
+            """, order_id, telegram_id, sku, price_cents)
+            await conn.execute("UPDATE users SET balance_cents=$2 WHERE telegram_id=$1", telegram_id, new_balance)
+            await conn.execute("""
+                INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref)
+                VALUES($1,'purchase',$2,$3,$4,$5)
+            """, telegram_id, -price_cents, balance, new_balance, f"order:{order_id}")
+    return True
+
+
+async def legacy_topup(pool: asyncpg.Pool, telegram_id: int, cents: int):
+    # /sumar before adjust_balance: read, add in Python, write the absolute value back.
+    async with pool.acquire() as conn:
+        before = int(await conn.fetchval("SELECT balance_cents FROM users WHERE telegram_id=$1", telegram_id))
+    after = before + cents
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            row = await conn.fetchrow("SELECT balance_cents FROM users WHERE telegram_id=$1 FOR UPDATE", telegram_id)
+            await conn.execute("UPDATE users SET balance_cents=$2 WHERE telegram_id=$1", telegram_id, after)
+            await conn.execute("""
+                INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref)
+                VALUES($1,'topup',$2,$3,$4,'bench')
+            """, telegram_id, cents, int(row["balance_cents"]), after)
+
+
+async def run_workers(concurrency: int, total: int, op) -> float:
+    remaining = iter(range(total))
+
+    async def worker(w: int):
+        for i in remaining:
+            await op(i)
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(w) for w in range(concurrency)))
+    return time.perf_counter() - t0
+
+
+async def bench_purchase(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+
+    async def legacy(i: int):
+        await legacy_deliver_purchase(pool, 1 + i % args.users, BENCH_SKU)
+
+    async def current(i: int):
+        await db.deliver_purchase(1 + i % args.users, BENCH_SKU)
+
+    for label, op in (("legacy (7 statements)", legacy), ("purchase_codes()", current)):
+        await reset(pool, args.users, args.purchases)
+        elapsed = await run_workers(args.concurrency, args.purchases, op)
+        print(f"{label:<24} {args.purchases} compras en {elapsed:.2f}s -> {args.purchases / elapsed:,.0f} compras/s")
+
+
+async def bench_quantity(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    codes = args.orders * args.n
+
+    async def one_by_one(i: int):
+        for _ in range(args.n):
+            await db.deliver_purchase(1 + i % args.users, BENCH_SKU)
+
+    async def batched(i: int):
+        await db.deliver_purchase(1 + i % args.users, BENCH_SKU, args.n)
+
+    for label, op in ((f"{args.n} x buy:SKU", one_by_one), (f"buy:SKU:{args.n}", batched)):
+        await reset(pool, args.users, codes)
+        elapsed = await run_workers(args.concurrency, args.orders, op)
+        print(f"{label:<16} {codes} códigos en {elapsed:.2f}s -> {codes / elapsed:,.0f} códigos/s")
+
+
+async def bench_ingest(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    codes = [uuid.uuid4().hex for _ in range(args.codes)]
+
+    await reset(pool, 1, 0)
+    t0 = time.perf_counter()
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            for c in codes:
+                await conn.execute("INSERT INTO codes(sku, code, status) VALUES($1,$2,'available')", BENCH_SKU, c)
+    elapsed = time.perf_counter() - t0
+    print(f"{'INSERT por fila':<16} {len(codes)} códigos en {elapsed:.2f}s -> {len(codes) / elapsed:,.0f} filas/s")
+
+    await reset(pool, 1, 0)
+    res = await db.add_codes(BENCH_SKU, codes)
+    print(f"{'add_codes (COPY)':<16} {res.inserted} códigos en {res.seconds:.2f}s -> {res.rate:,.0f} filas/s")
+    res = await db.add_codes(BENCH_SKU, codes)
+    print(f"{'re-pegado':<16} {res.duplicates} duplicados detectados en {res.seconds:.2f}s ({res.inserted} insertados)")
+
+
+async def bench_paste(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, 1, 0)
+    admin_id = 1
+    codes = [uuid.uuid4().hex for _ in range(args.codes)]
+    per_msg = 4096 // 33  # 32-char codes + newline per 4096-char Telegram message
+
+    await db.start_upload(admin_id, BENCH_SKU)
+    t0 = time.perf_counter()
+    for i in range(0, len(codes), per_msg):
+        await db.stage_codes(admin_id, codes[i:i + per_msg])
+    staged = time.perf_counter() - t0
+    sku, res = await db.commit_upload(admin_id)
+    print(f"{len(codes)} códigos pegados en {len(codes) // per_msg + 1} mensajes: staging {staged:.2f}s")
+    print(f"/done {sku}: {res.inserted} insertados, {res.duplicates} duplicados en {res.seconds:.2f}s")
+
+
+class FakeBotAPI:
+    # Minimal stand-in for api.telegram.org: answers every method, serves getUpdates from a queue and
+    # timestamps every reply per chat, which is what the latency numbers are measured against.
+    def __init__(self, flood_limits: bool = False, blocked_every: int = 0):
+        # With flood_limits, answers 429 like Telegram does past 30 msg/s overall or 1 msg/s per chat.
+        # With blocked_every=n, every chat id divisible by n answers 403 as if the user blocked the bot.
+        self.flood_limits = flood_limits
+        self.blocked_every = blocked_every
+        self.recent: List[float] = []
+        self.recent_by_chat: Dict[int, List[float]] = {}
+        self.flood_errors = 0
+        self.calls = 0
+        self.updates: List[dict] = []
+        self.new_updates = asyncio.Event()
+        self.sent: Dict[int, List[float]] = {}
+        self.replies: Dict[int, List[float]] = {}
+        self.expected = 0
+        self.received = 0
+        self.all_replied = asyncio.Event()
+        self.message_id = 0
+        self.runner = None
+
+    async def start(self, port: int) -> str:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", port).start()
+        return f"http://127.0.0.1:{port}"
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+    def expect(self, total: int):
+        self.sent, self.replies = {}, {}
+        self.expected, self.received = total, 0
+        self.all_replied.clear()
+
+    def push(self, update: dict):
+        self.updates.append(update)
+        self.new_updates.set()
+
+    def mark_sent(self, chat_id: int):
+        self.sent.setdefault(chat_id, []).append(time.perf_counter())
+
+    def latencies(self) -> List[float]:
+        out = []
+        for chat_id, sent in self.sent.items():
+            out.extend(r - s for s, r in zip(sent, self.replies.get(chat_id, [])))
+        return out
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(data)})
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendDocument"):
+            chat_id = int(data["chat_id"])
+            self.calls += 1
+            if self.blocked_every and chat_id % self.blocked_every == 0:
+                return web.json_response({
+                    "ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user",
+                }, status=403)
+            if self.flood_limits and self._flooded(chat_id):
+                self.flood_errors += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+            self.replies.setdefault(chat_id, []).append(time.perf_counter())
+            self.received += 1
+            if self.received >= self.expected:
+                self.all_replied.set()
+            self.message_id += 1
+            result = {"message_id": self.message_id, "date": int(time.time()),
+                      "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def _flooded(self, chat_id: int) -> bool:
+        now = time.perf_counter()
+        self.recent = [t for t in self.recent if now - t < 1.0]
+        chat = [t for t in self.recent_by_chat.get(chat_id, []) if now - t < 1.0]
+        self.recent_by_chat[chat_id] = chat
+        if len(self.recent) >= 30 or len(chat) >= 3:
+            return True
+        self.recent.append(now)
+        chat.append(now)
+        return False
+
+    async def _get_updates(self, data) -> List[dict]:
+        offset = int(data.get("offset", 0))
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout=int(data.get("timeout", 0)) or 0.01)
+            except asyncio.TimeoutError:
+                return []
+        return self.updates[:100]
+
+
+def synthetic_update(update_id: int, user_id: int, text: str = "/id") -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Bench", "username": f"bench{user_id}"},
+            "text": text,
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+async def drive(api: FakeBotAPI, args, inject) -> List[float]:
+    # Open-loop arrivals at args.rate updates/s, so a slow mode shows up as latency, not as a lower send rate.
+    api.expect(args.updates)
+    t0 = time.perf_counter()
+    for i in range(args.updates):
+        await asyncio.sleep(max(0.0, t0 + i / args.rate - time.perf_counter()))
+        user_id = 1 + i % args.users
+        api.mark_sent(user_id)
+        inject(synthetic_update(i + 1, user_id))
+    await asyncio.wait_for(api.all_replied.wait(), timeout=120)
+    return api.latencies()
+
+
+def report_latency(label: str, lat: List[float]):
+    q = statistics.quantiles(lat, n=100)
+    print(f"{label:<16} n={len(lat)}  p50={q[49] * 1000:.1f}ms  p99={q[98] * 1000:.1f}ms  max={max(lat) * 1000:.1f}ms")
+
+
+async def bench_webhook(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    api = FakeBotAPI()
+    bot = Bot(BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(await api.start(args.api_port))))
+    # The outbox rate limits are lifted here: this measures the update path, not Telegram's quotas.
+    outbox = Outbox(bot, rate=1e6)
+    outbox.start()
+    try:
+        db = DB(pool)
+        dp = build_dispatcher(db, outbox, Broadcaster(db, outbox))
+        polling = asyncio.create_task(
+            dp.start_polling(bot, polling_timeout=1, handle_signals=False, close_bot_session=False)
+        )
+        report_latency("polling", await drive(api, args, api.push))
+        await dp.stop_polling()
+        await polling
+
+        server = WebhookServer(bot, dp, "bench-secret", args.max_concurrency)
+        runner = web.AppRunner(server.app())
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", args.webhook_port).start()
+        url = f"http://127.0.0.1:{args.webhook_port}{WEBHOOK_PATH}"
+        posts = set()
+        async with aiohttp.ClientSession(headers={"X-Telegram-Bot-Api-Secret-Token": "bench-secret"}) as http:
+            def inject(update: dict):
+                task = asyncio.create_task(http.post(url, json=update))
+                posts.add(task)
+                task.add_done_callback(lambda t: (posts.discard(t), t.result().release()))
+
+            report_latency("webhook", await drive(api, args, inject))
+            await server.drain(10)
+        await runner.cleanup()
+    finally:
+        await outbox.close()
+        await bot.session.close()
+        await api.stop()
+
+
+async def bench_scale(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+    api = FakeBotAPI()
+    url = await api.start(args.api_port)
+    # Worker processes are spawned and re-import bot.py, so they read these at startup.
+    os.environ.update(BOT_TOKEN=BENCH_TOKEN, TELEGRAM_API_URL=url, OUTBOX_RATE="1000000")
+    update_id = 0
+
+    async def burst(n: int) -> float:
+        nonlocal update_id
+        api.expect(n)
+        t0 = time.perf_counter()
+        for i in range(n):
+            update_id += 1
+            api.push(synthetic_update(update_id, 1 + i))  # one update per chat: per-chat limits stay out of the way
+        await asyncio.wait_for(api.all_replied.wait(), timeout=300)
+        return time.perf_counter() - t0
+
+    counts = sorted({1, *(n for n in (2, 4, 8, 16) if n < args.workers), args.workers})
+    base = None
+    try:
+        for n in counts:
+            await reset(pool, args.updates, 0)
+            bot = Bot(BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+            stop = asyncio.Event()
+            sup = asyncio.create_task(run_supervisor(bot, n, BENCH_DATABASE_URL, ["message"], stop))
+            await burst(args.updates)  # warm-up: spawns workers and fills every profile cache
+            elapsed = await burst(args.updates)
+            rate = args.updates / elapsed
+            base = base or rate
+            print(f"{n:>2} workers: {args.updates} updates en {elapsed:.2f}s -> {rate:,.0f} updates/s (x{rate / base:.2f})")
+            stop.set()
+            await sup
+    finally:
+        await api.stop()
+
+
+async def bench_doubletap(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+
+    async def sample_lock_waits(stop: asyncio.Event) -> int:
+        waits = 0
+        async with pool.acquire() as conn:
+            while not stop.is_set():
+                waits += await conn.fetchval("SELECT COUNT(*) FROM pg_locks WHERE NOT granted")
+                await asyncio.sleep(0.005)
+        return waits
+
+    for label, window in (("sin dedupe", 0.0), ("con dedupe", 3.0)):
+        await reset(pool, args.users, args.users * args.taps)
+        db = DB(pool)
+        db.double_tap_seconds = window
+        stop = asyncio.Event()
+        sampler = asyncio.create_task(sample_lock_waits(stop))
+        t0 = time.perf_counter()
+        # Every user taps buy:BENCH `taps` times at once, each tap with its own callback query id.
+        await asyncio.gather(*(
+            db.deliver_purchase(u, BENCH_SKU, request_id=f"{u}:{t}")
+            for u in range(1, args.users + 1) for t in range(args.taps)
+        ))
+        elapsed = time.perf_counter() - t0
+        stop.set()
+        waits = await sampler
+        async with pool.acquire() as conn:
+            orders = await conn.fetchval("SELECT COUNT(*) FROM orders")
+        print(f"{label:<11} {args.users * args.taps} taps -> {orders} compras en {elapsed:.2f}s, "
+              f"muestras de espera por lock: {waits}")
+
+
+async def bench_balance(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    db.double_tap_seconds = 0
+
+    async def legacy(uid: int):
+        await legacy_topup(pool, uid, 100)
+
+    async def current(uid: int):
+        await db.adjust_balance(uid, 100, "topup", ref="bench")
+
+    for label, topup in (("get+set", legacy), ("adjust_balance", current)):
+        # Few users, so purchases and topups keep landing on the same rows.
+        await reset(pool, args.users, args.ops, price_cents=100)
+
+        async def op(i: int):
+            uid = 1 + i % args.users
+            if i % 2:
+                await topup(uid)
+            else:
+                await db.deliver_purchase(uid, BENCH_SKU)
+
+        elapsed = await run_workers(args.concurrency, args.ops, op)
+        async with pool.acquire() as conn:
+            # The ledger must explain every balance, and each move must start where the previous one ended.
+            lost = await conn.fetchval("""
+                SELECT COUNT(*) FROM users u
+                WHERE u.balance_cents <> $1 + (SELECT COALESCE(SUM(amount_cents), 0) FROM balance_moves m
+                                               WHERE m.telegram_id = u.telegram_id)
+            """, 10**9)
+            broken = await conn.fetchval("""
+                SELECT COUNT(*) FROM (
+                    SELECT balance_before_cents,
+                           lag(balance_after_cents) OVER (PARTITION BY telegram_id ORDER BY id) AS prev
+                    FROM balance_moves
+                ) t WHERE balance_before_cents <> prev
+            """)
+        print(f"{label:<16} {args.ops} operaciones en {elapsed:.2f}s -> {args.ops / elapsed:,.0f}/s, "
+              f"usuarios con saldo descuadrado: {lost}, movimientos encadenados mal: {broken}")
+        # The read-modify-write baseline is expected to drift; adjust_balance must not.
+        if topup is current and (lost or broken):
+            raise SystemExit(f"❌ adjust_balance dejó {lost} saldos descuadrados y {broken} movimientos mal encadenados")
+
+
+async def bench_topups(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    usernames = [f"bench{1 + i % args.users}" for i in range(args.rows)]
+
+    t0 = time.perf_counter()
+    for i, name in enumerate(usernames):
+        uid = await db.user_id_by_username(name)
+        await db.adjust_balance(uid, 100, "topup", ref=f"uno-a-uno:{i}")
+    elapsed = time.perf_counter() - t0
+    print(f"{'/sumar por fila':<16} {args.rows} recargas en {elapsed:.2f}s -> {args.rows / elapsed:,.0f}/s")
+
+    for label in ("/recargas", "reenvío"):
+        t0 = time.perf_counter()
+        ids = await db.resolve_usernames(usernames)
+        applied = await db.apply_topups(1, [(f"lote:{i}", ids[name], 100) for i, name in enumerate(usernames)])
+        elapsed = time.perf_counter() - t0
+        print(f"{label:<16} {args.rows} filas, {len(applied)} aplicadas en {elapsed:.2f}s -> {args.rows / elapsed:,.0f}/s")
+    async with pool.acquire() as conn:
+        lost = await conn.fetchval("""
+            SELECT COUNT(*) FROM users u
+            WHERE u.balance_cents <> $1 + (SELECT COALESCE(SUM(amount_cents), 0) FROM balance_moves m
+                                           WHERE m.telegram_id = u.telegram_id)
+        """, 10**9)
+    print(f"usuarios con saldo descuadrado: {lost}")
+
+
+async def bench_usernames(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    names = [f"@Bench{1 + (i * 7919) % args.users}" for i in range(args.lookups)]
+
+    async def timed(label: str, resolve):
+        latencies: List[float] = []
+        for name in names:
+            t0 = time.perf_counter()
+            await resolve(name)
+            latencies.append(time.perf_counter() - t0)
+        report_latency(label, latencies)
+
+    async def legacy(name: str):
+        # The old exact-match lookup, with no index on username.
+        async with pool.acquire() as conn:
+            await conn.fetchval("SELECT telegram_id FROM users WHERE username=$1", name.lstrip("@"))
+
+    async def uncached(name: str):
+        db._usernames.clear()
+        await db.user_id_by_username(name)
+
+    await timed("username=$1", legacy)
+    await timed("lower() índice", uncached)
+    for name in names:
+        await db.user_id_by_username(name)  # warm: --lookups stays under USERNAME_CACHE_SIZE
+    await timed("caché LRU", db.user_id_by_username)
+
+
+async def bench_balancecache(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, args.purchases)
+    # Two "replicas" sharing the pool, each with its own LISTEN connection.
+    buyer, other = DB(pool), DB(pool)
+    buyer.double_tap_seconds = 0
+    await buyer.start_listener(BENCH_DATABASE_URL)
+    await other.start_listener(BENCH_DATABASE_URL)
+    try:
+        own_stale = other_stale = 0
+        for i in range(args.purchases):
+            uid = 1 + i % args.users
+            await buyer.deliver_purchase(uid, BENCH_SKU)
+            async with pool.acquire() as conn:
+                truth = await conn.fetchval("SELECT balance_cents FROM users WHERE telegram_id=$1", uid)
+            own_stale += await buyer.get_balance(uid) != truth
+            other_stale += await other.get_balance(uid) != truth
+        print(f"saldos viejos tras {args.purchases} compras: mismo proceso {own_stale}, otra réplica {other_stale}")
+
+        async def taps(db: DB) -> List[float]:
+            latencies: List[float] = []
+            for i in range(args.taps):
+                t0 = time.perf_counter()
+                await db.get_balance(1 + i % args.users)
+                latencies.append(time.perf_counter() - t0)
+            return latencies
+
+        uncached = DB(pool)  # no listener: every read goes to the DB
+        report_latency("SELECT", await taps(uncached))
+        report_latency("caché", await taps(buyer))
+    finally:
+        await buyer.stop_listener()
+        await other.stop_listener()
+
+
+async def bench_outbox(args):
+    api = FakeBotAPI(flood_limits=True)
+    bot = Bot(BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(await api.start(args.api_port))))
+    outbox = Outbox(bot)
+    outbox.start()
+    latencies: Dict[int, List[float]] = {PRIO_DELIVERY: [], PRIO_REPLY: []}
+
+    def track(fut: asyncio.Future, priority: int):
+        t0 = time.perf_counter()
+        fut.add_done_callback(lambda f: latencies[priority].append(time.perf_counter() - t0))
+
+    try:
+        # A rush: every chat keeps re-rendering its menu while purchases come in behind the backlog.
+        t0 = time.perf_counter()
+        for i in range(args.edits):
+            chat_id = 1 + i % args.chats
+            track(outbox.submit(EditMessageText(chat_id=chat_id, message_id=1, text=f"menú {i}"), PRIO_REPLY), PRIO_REPLY)
+        for i in range(args.deliveries):
+            chat_id = 1 + i % args.chats
+            track(outbox.submit(SendMessage(chat_id=chat_id, text=f"código {i}"), PRIO_DELIVERY), PRIO_DELIVERY)
+        await outbox.close(timeout=300)
+        elapsed = time.perf_counter() - t0
+        await asyncio.sleep(0.1)  # let the last done-callbacks run
+        print(f"{args.edits} ediciones + {args.deliveries} entregas -> {api.calls} llamadas a la API en {elapsed:.1f}s, "
+              f"429 recibidos: {api.flood_errors}")
+        report_latency("entregas", latencies[PRIO_DELIVERY])
+        report_latency("menús", latencies[PRIO_REPLY])
+    finally:
+        await bot.session.close()
+        await api.stop()
+
+
+async def bench_broadcast(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    api = FakeBotAPI(blocked_every=args.blocked_every)
+    bot = Bot(BENCH_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(await api.start(args.api_port))))
+    # Telegram caps a real bot at ~30 msg/s (about an hour for 100k users); lifted here to measure the engine.
+    outbox = Outbox(bot, rate=args.rate)
+    outbox.start()
+    broadcaster = Broadcaster(db, outbox)
+    admin_id = args.users + 1  # not a recipient: its status messages stay out of the counts
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    try:
+        t0 = time.perf_counter()
+        broadcast_id = await broadcaster.begin(admin_id, "¡Ya hay stock!")
+        await broadcaster.tasks[broadcast_id]
+        elapsed = time.perf_counter() - t0
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT status, sent, failed, blocked FROM broadcasts WHERE id=$1", broadcast_id)
+            marked = await conn.fetchval("SELECT COUNT(*) FROM users WHERE blocked_at IS NOT NULL")
+        print(f"{args.users} usuarios en {elapsed:.1f}s -> {args.users / elapsed:,.0f} envíos/s ({row['status']}), "
+              f"páginas de {broadcaster.batch}")
+        print(f"enviados={row['sent']} bloqueados={row['blocked']} (marcados: {marked}) fallidos={row['failed']}, "
+              f"RSS máx. +{(rss - rss0) / 1024:.1f} MB")
+    finally:
+        await broadcaster.close()
+        await outbox.close()
+        await bot.session.close()
+        await api.stop()
+
+
+async def bench_claim(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    db.double_tap_seconds = 0  # the claim alone
+    for history in args.history:
+        for label, index in (("sku,status", "codes(sku, status)"), ("parcial", None)):
+            await reset(pool, args.users, 0)
+            async with pool.acquire() as conn:
+                # Sold codes first, so they sit at the low ids the claim's ORDER BY id starts from.
+                await conn.execute("""
+                    INSERT INTO codes(sku, code, status, delivered_at)
+                    SELECT $1, md5(g::TEXT || ':vendido'), 'delivered', now() FROM generate_series(1, $2) g
+                """, BENCH_SKU, history)
+                await conn.execute("""
+                    INSERT INTO codes(sku, code, status) SELECT $1, md5(g::TEXT), 'available' FROM generate_series(1, $2) g
+                """, BENCH_SKU, args.purchases)
+                await conn.execute("UPDATE product_stock SET available=$2 WHERE sku=$1", BENCH_SKU, args.purchases)
+                if index:
+                    # The pre-partial-index layout.
+                    await conn.execute(f"DROP INDEX idx_codes_available; CREATE INDEX idx_codes_sku_status ON {index}")
+                await conn.execute("VACUUM ANALYZE codes")
+            latencies: List[float] = []
+
+            async def claim(i: int):
+                t0 = time.perf_counter()
+                await db.deliver_purchase(1 + i % args.users, BENCH_SKU)
+                latencies.append(time.perf_counter() - t0)
+
+            try:
+                await run_workers(args.concurrency, args.purchases, claim)
+            finally:
+                if index:
+                    async with pool.acquire() as conn:
+                        await conn.execute(
+                            "DROP INDEX idx_codes_sku_status; "
+                            "CREATE INDEX idx_codes_available ON codes(sku, id) WHERE status = 'available'"
+                        )
+            report_latency(f"{history // 1000}k {label}", latencies)
+
+
+async def bench_archive(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    db.double_tap_seconds = 0
+    for label, archiving in (("solo compras", False), ("con archivo", True)):
+        await reset(pool, args.users, 0)
+        async with pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO codes(sku, code, status, delivered_at)
+                SELECT $1, md5(g::TEXT || ':vendido'), 'delivered', now() - interval '60 days' FROM generate_series(1, $2) g
+            """, BENCH_SKU, args.history)
+            await conn.execute("""
+                INSERT INTO codes(sku, code, status) SELECT $1, md5(g::TEXT), 'available' FROM generate_series(1, $2) g
+            """, BENCH_SKU, args.purchases)
+            await conn.execute("UPDATE product_stock SET available=$2 WHERE sku=$1", BENCH_SKU, args.purchases)
+            await conn.execute("VACUUM ANALYZE codes")
+        latencies: List[float] = []
+
+        async def buy(i: int):
+            t0 = time.perf_counter()
+            await db.deliver_purchase(1 + i % args.users, BENCH_SKU)
+            latencies.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        archiver = asyncio.create_task(db.archive_codes(older_than_days=30)) if archiving else None
+        await run_workers(args.concurrency, args.purchases, buy)
+        if archiver:
+            moved = await archiver
+            elapsed = time.perf_counter() - t0
+            print(f"archivados {moved} códigos en {elapsed:.1f}s -> {moved / elapsed:,.0f}/s")
+        report_latency(label, latencies)
+
+
+async def bench_init(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+    # Before schema_version, every boot re-ran the whole IF NOT EXISTS script.
+    t0 = time.perf_counter()
+    for _ in range(args.boots):
+        async with pool.acquire() as conn:
+            for migration in MIGRATIONS:
+                if migration.sql:
+                    await conn.execute(migration.sql)
+    legacy = (time.perf_counter() - t0) / args.boots
+    t0 = time.perf_counter()
+    for _ in range(args.boots):
+        await DB(pool).init(BENCH_DATABASE_URL)
+    current = (time.perf_counter() - t0) / args.boots
+    print(f"{'script completo':<16} {legacy * 1000:.1f} ms por arranque")
+    print(f"{'schema_version':<16} {current * 1000:.1f} ms por arranque")
+
+
+# Same statements as the first page of DB.orders_page and DB.sales_report, plus their TEXT-timestamp
+# equivalents run against a copy of orders in the old layout (TEXT columns, index on the TEXT column).
+PLAN_QUERIES = [
+    ("mis compras", """
+        SELECT order_id, sku, price_cents, delivered_at FROM {orders}
+        WHERE telegram_id=$1 ORDER BY delivered_at DESC, order_id DESC LIMIT 10
+    """, """
+        SELECT order_id, sku, price_cents, delivered_at FROM {orders}
+        WHERE telegram_id=$1 ORDER BY delivered_at DESC LIMIT 10
+    """),
+    ("ventas 7 días", """
+        SELECT (delivered_at AT TIME ZONE $1)::date AS day, sku,
+               COUNT(*)::INTEGER AS orders, SUM(quantity)::INTEGER AS units, SUM(price_cents)::BIGINT AS cents
+        FROM {orders}
+        WHERE delivered_at >= (date_trunc('day', now() AT TIME ZONE $1) - make_interval(days => $2 - 1)) AT TIME ZONE $1
+          AND status = 'paid_delivered'
+        GROUP BY 1, 2 ORDER BY 1, 2
+    """, """
+        SELECT substr(delivered_at, 1, 10) AS day, sku,
+               COUNT(*)::INTEGER AS orders, SUM(quantity)::INTEGER AS units, SUM(price_cents)::BIGINT AS cents
+        FROM {orders}
+        WHERE delivered_at >= to_char(now() AT TIME ZONE $1 - make_interval(days => $2 - 1), 'YYYY-MM-DD')
+          AND status = 'paid_delivered'
+        GROUP BY 1, 2 ORDER BY 1, 2
+    """),
+]
+
+
+async def bench_plans(pool: asyncpg.Pool, args):
+    await DB(pool).init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    async with pool.acquire() as conn:
+        # Orders spread evenly over the last args.days days.
+        await conn.execute("""
+            INSERT INTO orders(order_id, telegram_id, sku, price_cents, quantity, status, created_at, delivered_at)
+            SELECT 'B' || g, 1 + g % $1, $2, 100, 1, 'paid_delivered', t, t
+            FROM generate_series(1, $3) g, LATERAL (SELECT now() - make_interval(secs => g * $4 * 86400.0 / $3) AS t) ts
+        """, args.users, BENCH_SKU, args.orders, args.days)
+        await conn.execute("DROP TABLE IF EXISTS bench_legacy_orders")
+        await conn.execute(f"""
+            CREATE TABLE bench_legacy_orders AS
+            SELECT order_id, telegram_id, sku, price_cents, quantity, status,
+                   to_char(created_at AT TIME ZONE '{TIMEZONE.key}', 'YYYY-MM-DD HH24:MI:SS') AS created_at,
+                   to_char(delivered_at AT TIME ZONE '{TIMEZONE.key}', 'YYYY-MM-DD HH24:MI:SS') AS delivered_at
+            FROM orders
+        """)
+        await conn.execute("CREATE INDEX ON bench_legacy_orders(telegram_id, delivered_at)")
+        await conn.execute("ANALYZE orders; ANALYZE bench_legacy_orders")
+        try:
+            for label, current, legacy in PLAN_QUERIES:
+                params = (1,) if "$2" not in current else (TIMEZONE.key, 7)
+                for when, sql, table in (("antes (TEXT)", legacy, "bench_legacy_orders"), ("después", current, "orders")):
+                    plan = await conn.fetch("EXPLAIN (ANALYZE, BUFFERS) " + sql.format(orders=table), *params)
+                    print(f"=== {label} — {when}")
+                    print("\n".join(r[0] for r in plan))
+        finally:
+            await conn.execute("DROP TABLE bench_legacy_orders")
+
+
+async def bench_ledger(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, args.users, 0)
+    async with pool.acquire() as conn:
+        await conn.execute("""
+            INSERT INTO balance_moves(telegram_id, type, amount_cents, balance_before_cents, balance_after_cents, ref, created_at)
+            SELECT 1 + g % $1, 'purchase', -100, 1000, 900, 'order:B' || g, now() - make_interval(secs => g * $3 * 86400.0 / $2)
+            FROM generate_series(1, $2) g
+        """, args.users, args.moves, args.days)
+        # The ledger before partitioning: one heap, no index on the user.
+        await conn.execute("DROP TABLE IF EXISTS bench_flat_moves")
+        await conn.execute("CREATE TABLE bench_flat_moves AS SELECT * FROM balance_moves")
+        await conn.execute("ANALYZE balance_moves; ANALYZE bench_flat_moves")
+        try:
+            for label, table in (("sin partición", "bench_flat_moves"), ("particionado", "balance_moves")):
+                sql = f"""
+                    SELECT created_at, type, amount_cents, balance_after_cents, ref FROM {table}
+                    WHERE telegram_id=$1 ORDER BY created_at DESC LIMIT $2
+                """
+                latencies: List[float] = []
+                for i in range(args.statements):
+                    t0 = time.perf_counter()
+                    await conn.fetch(sql, 1 + i % args.users, 20)
+                    latencies.append(time.perf_counter() - t0)
+                report_latency(label, latencies)
+                plan = await conn.fetch("EXPLAIN (ANALYZE, BUFFERS) " + sql, 1, 20)
+                print("\n".join(r[0] for r in plan))
+        finally:
+            await conn.execute("DROP TABLE bench_flat_moves")
+    t0 = time.perf_counter()
+    res = await db.maintain_ledger()
+    print(f"mantenimiento de particiones: {(time.perf_counter() - t0) * 1000:.1f} ms {res}")
+
+
+async def bench_history(pool: asyncpg.Pool, args):
+    db = DB(pool)
+    await db.init(BENCH_DATABASE_URL)
+    await reset(pool, 1, 0)
+    async with pool.acquire() as conn:
+        # One reseller with a long history, plus background orders from other users.
+        await conn.execute("INSERT INTO users(telegram_id, balance_cents) SELECT g, 0 FROM generate_series(2, 1000) g")
+        await conn.execute("""
+            INSERT INTO orders(order_id, telegram_id, sku, price_cents, quantity, status, created_at, delivered_at)
+            SELECT 'B' || g, CASE WHEN g % 4 = 0 THEN 1 ELSE 2 + g % 999 END, $1, 100, 1, 'paid_delivered', t, t
+            FROM generate_series(1, $2) g, LATERAL (SELECT now() - make_interval(secs => g) AS t) ts
+        """, BENCH_SKU, args.orders)
+        await conn.execute("ANALYZE orders")
+
+        async def walk(label: str, fetch_page):
+            latencies: List[float] = []
+            cursor = None
+            for page in range(args.pages):
+                t0 = time.perf_counter()
+                rows, cursor = await fetch_page(page, cursor)
+                latencies.append(time.perf_counter() - t0)
+                if not rows:
+                    break
+            report_latency(label, latencies)
+            print(f"{'':<16} última página ({len(latencies)}): {latencies[-1] * 1000:.2f} ms")
+
+        async def offset_page(page: int, _):
+            rows = await conn.fetch("""
+                SELECT order_id, sku, price_cents, delivered_at FROM orders WHERE telegram_id=1
+                ORDER BY delivered_at DESC, order_id DESC LIMIT $1 OFFSET $2
+            """, args.page_size, page * args.page_size)
+            return rows, None
+
+        async def keyset_page(_, cursor):
+            rows, _ = await db.orders_page(1, cursor, limit=args.page_size)
+            return rows, (rows[-1]["delivered_at"], rows[-1]["order_id"]) if rows else None
+
+        await walk("OFFSET", offset_page)
+        await walk("keyset", keyset_page)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("purchase", help="legacy multi-statement purchase vs purchase_codes()")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--purchases", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=bench_purchase)
+
+    p = sub.add_parser("quantity", help="N single purchases vs one quantity purchase of N codes")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--orders", type=int, default=500)
+    p.add_argument("--n", type=int, default=25)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=bench_quantity)
+
+    p = sub.add_parser("ingest", help="per-row INSERT vs chunked COPY in add_codes")
+    p.add_argument("--codes", type=int, default=100000)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_ingest)
+
+    p = sub.add_parser("paste", help="stage pasted messages then commit them with /done")
+    p.add_argument("--codes", type=int, default=10000)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_paste)
+
+    p = sub.add_parser("webhook", help="update->reply latency, polling vs webhook, against a fake Bot API")
+    p.add_argument("--users", type=int, default=500)
+    p.add_argument("--updates", type=int, default=3000)
+    p.add_argument("--rate", type=float, default=300, help="synthetic updates per second")
+    p.add_argument("--max-concurrency", type=int, default=40)
+    p.add_argument("--api-port", type=int, default=8765)
+    p.add_argument("--webhook-port", type=int, default=8766)
+    p.add_argument("--concurrency", type=int, default=5)
+    p.set_defaults(func=bench_webhook)
+
+    p = sub.add_parser("scale", help="update throughput of the sharded supervisor with 1..N worker processes")
+    p.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    p.add_argument("--updates", type=int, default=20000)
+    p.add_argument("--api-port", type=int, default=8765)
+    p.add_argument("--concurrency", type=int, default=5)
+    p.set_defaults(func=bench_scale)
+
+    p = sub.add_parser("doubletap", help="replayed double taps with and without purchase dedupe")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--taps", type=int, default=2)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=bench_doubletap)
+
+    p = sub.add_parser("balance", help="concurrent purchases and topups, read-modify-write vs adjust_balance, ledger check")
+    p.add_argument("--users", type=int, default=5)
+    p.add_argument("--ops", type=int, default=10000)
+    p.add_argument("--concurrency", type=int, default=20)
+    p.set_defaults(func=bench_balance)
+
+    p = sub.add_parser("topups", help="CSV top-up import: per-row /sumar vs one set-based /recargas, then a re-send")
+    p.add_argument("--users", type=int, default=1000)
+    p.add_argument("--rows", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_topups)
+
+    p = sub.add_parser("usernames", help="@usuario resolution: unindexed exact match vs lower() index vs LRU cache")
+    p.add_argument("--users", type=int, default=500000)
+    p.add_argument("--lookups", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_usernames)
+
+    p = sub.add_parser("balancecache", help="'Mi saldo' from the balance cache vs SELECT, and stale reads across replicas")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--purchases", type=int, default=2000)
+    p.add_argument("--taps", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=5)
+    p.set_defaults(func=bench_balancecache)
+
+    p = sub.add_parser("outbox", help="outbound queue vs a fake Bot API that enforces flood limits (no DB needed)")
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--edits", type=int, default=1000)
+    p.add_argument("--deliveries", type=int, default=200)
+    p.add_argument("--api-port", type=int, default=8765)
+    p.set_defaults(func=bench_outbox, needs_db=False)
+
+    p = sub.add_parser("broadcast", help="/broadcast to every user against a fake Bot API, with some users blocked")
+    p.add_argument("--users", type=int, default=100000)
+    p.add_argument("--blocked-every", type=int, default=20)
+    p.add_argument("--rate", type=float, default=1e6, help="outbox msg/s (Telegram allows ~30)")
+    p.add_argument("--api-port", type=int, default=8765)
+    p.add_argument("--concurrency", type=int, default=5)
+    p.set_defaults(func=bench_broadcast)
+
+    p = sub.add_parser("claim", help="purchase latency as delivered history grows, (sku, status) vs partial index")
+    p.add_argument("--history", type=int, nargs="+", default=[0, 1000000, 3000000])
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--purchases", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=bench_claim)
+
+    p = sub.add_parser("archive", help="purchase latency while delivered history is moved to codes_history")
+    p.add_argument("--history", type=int, default=1000000)
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--purchases", type=int, default=5000)
+    p.add_argument("--concurrency", type=int, default=10)
+    p.set_defaults(func=bench_archive)
+
+    p = sub.add_parser("init", help="startup schema check: full DDL script vs the schema_version fast path")
+    p.add_argument("--boots", type=int, default=20)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_init)
+
+    p = sub.add_parser("plans", help="EXPLAIN ANALYZE of order history and sales, TEXT vs timestamptz timestamps")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--orders", type=int, default=500000)
+    p.add_argument("--days", type=int, default=180)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_plans)
+
+    p = sub.add_parser("ledger", help="per-user statement latency, flat unindexed balance_moves vs monthly partitions")
+    p.add_argument("--users", type=int, default=5000)
+    p.add_argument("--moves", type=int, default=2000000)
+    p.add_argument("--days", type=int, default=365)
+    p.add_argument("--statements", type=int, default=200)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_ledger)
+
+    p = sub.add_parser("history", help="deep order-history pages for one reseller, OFFSET vs keyset")
+    p.add_argument("--orders", type=int, default=2000000)
+    p.add_argument("--pages", type=int, default=2000)
+    p.add_argument("--page-size", type=int, default=8)
+    p.add_argument("--concurrency", type=int, default=1)
+    p.set_defaults(func=bench_history)
+
+    args = parser.parse_args()
+    if not getattr(args, "needs_db", True):
+        await args.func(args)
+        return
+    if not BENCH_DATABASE_URL:
+        raise RuntimeError("Falta BENCH_DATABASE_URL (usa una base de datos desechable).")
+
+    pool = await asyncpg.create_pool(BENCH_DATABASE_URL, min_size=1, max_size=max(5, args.concurrency))
+    try:
+        await args.func(pool, args)
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
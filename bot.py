@@ -1,14 +1,31 @@
 import asyncio
+import codecs
+import csv
+import hmac
+import io
+import multiprocessing as mp
 import os
+import queue
 import re
+import signal
+import time
 import uuid
-from datetime import datetime
-from typing import Optional, List, Tuple
+from collections import OrderedDict, deque
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from typing import Optional, List, Tuple, Dict, Set, NamedTuple, AsyncIterator, Awaitable, Callable
 
 import asyncpg
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
 from aiogram.filters import Command, CommandStart
-from aiogram.types import Message, CallbackQuery
+from aiogram.methods import EditMessageText, SendDocument, SendMessage, TelegramMethod
+from aiogram.types import Message, CallbackQuery, BufferedInputFile, ReplyParameters, Update
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from dotenv import load_dotenv
 
@@ -17,8 +34,63 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
 ADMIN_IDS_RAW = os.getenv("ADMIN_IDS", "").strip()
 DATABASE_URL = os.getenv("DATABASE_URL", "").strip()  # Railway Postgres
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip()  # optional, e.g. a local Bot API server
+
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()  # polling|webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()  # public base URL, e.g. https://mi-bot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip()
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()  # required with webhook; Telegram sends it on every update
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "40"))
+WEBHOOK_DRAIN_SECONDS = float(os.getenv("WEBHOOK_DRAIN_SECONDS", "20"))
+
+WORKERS = int(os.getenv("WORKERS", "1"))  # >1: supervisor + N worker processes sharded by user
+WORKER_CONCURRENCY = int(os.getenv("WORKER_CONCURRENCY", "40"))  # handlers in flight per worker
+WORKER_QUEUE_SIZE = 1000
+WORKER_RESPAWN_SECONDS = 5.0  # min. gap between restarts of a worker that died
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))  # per process
+TIMEZONE = ZoneInfo(os.getenv("TIMEZONE", "America/Mexico_City"))  # dates shown to users and in /ventas
+# Zone of the server that wrote the old TEXT timestamps (datetime.now() on Railway, i.e. UTC).
+LEGACY_TIMEZONE = ZoneInfo(os.getenv("LEGACY_TIMEZONE", "UTC"))
+TIMESTAMP_BATCH = 10000  # rows per transaction while converting TEXT timestamps
+
+# Outgoing message limits (Telegram: ~30 msg/s per bot, ~1 msg/s per chat, 20 msg/min per group).
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "28"))  # whole bot; split across WORKERS
+CHAT_RATE, CHAT_BURST = 1.0, 3
+GROUP_RATE, GROUP_BURST = 20 / 60, 3
+OUTBOX_MAX_ATTEMPTS = 5
+PRIO_DELIVERY, PRIO_REPLY, PRIO_BULK = 0, 1, 2  # outbox lanes, most urgent first
 
 CURRENCY = "MXN"
+MAX_BUY_QTY = 200
+BUY_MORE_QTYS = (1, 5, 10, 25)
+INGEST_CHUNK = 5000  # codes per COPY/transaction in add_codes
+PROGRESS_EDIT_SECONDS = 2.0  # min. gap between progress edits while ingesting a document
+MAX_DOCUMENT_BYTES = 20 * 1024 * 1024  # Bot API getFile download limit
+INLINE_CODES_MAX_CHARS = 3500  # above this, multi-code purchases are sent as a .txt file
+ORDERS_PAGE = 8  # orders per page in "📦 Mis compras"
+PROFILE_FLUSH_SECONDS = 5.0  # write-behind interval for username/first_name changes
+DOUBLE_TAP_SECONDS = float(os.getenv("DOUBLE_TAP_SECONDS", "3"))  # repeat purchases inside this window are deduped
+CATALOG_CHANNEL = "catalog"  # NOTIFY channel for product changes
+USERNAMES_CHANNEL = "usernames"  # NOTIFY channel for profile writes, payload "telegram_id:username"
+USERNAME_CACHE_SIZE = 4096  # @usuario -> telegram_id lookups kept per process
+BLOCKED_CHANNEL = "blocked"  # NOTIFY channel for users a broadcast found blocked, payload "telegram_id"
+BALANCES_CHANNEL = "balances"  # sent by the users_balance_version trigger, payload "telegram_id:version:balance"
+BALANCE_CACHE_SIZE = 50000  # balances kept per process
+LISTEN_RETRY_SECONDS = 5.0
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "30"))  # delivered codes older than this go to codes_history
+ARCHIVE_BATCH = 5000  # codes moved per transaction
+ARCHIVE_INTERVAL_SECONDS = 600.0
+# balance_moves is partitioned by calendar month (UTC). Partitions are created this many months ahead; with a
+# retention set, months older than that are detached (kept as standalone tables, never dropped by the bot).
+LEDGER_MONTHS_AHEAD = 3
+LEDGER_RETENTION_MONTHS = int(os.getenv("LEDGER_RETENTION_MONTHS", "0"))  # 0 = keep every month attached
+LEDGER_MAINTENANCE_SECONDS = 6 * 3600.0
+STATEMENT_ROWS = 20  # moves shown by /movs
+BROADCAST_BATCH = 500  # recipients read, sent and checkpointed per step
+BROADCAST_LEASE_SECONDS = 120.0  # a broadcast whose owner stops renewing this is taken over by another process
+BROADCAST_PROGRESS_SECONDS = 10.0
 
 ADMIN_IDS = set()
 if ADMIN_IDS_RAW:
@@ -32,8 +104,8 @@ def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
 
-def now_str() -> str:
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def fmt_ts(ts: Optional[datetime]) -> str:
+    return ts.astimezone(TIMEZONE).strftime("%Y-%m-%d %H:%M") if ts else "-"
 
 
 def money_to_cents(amount_str: str) -> Optional[int]:
@@ -54,6 +126,30 @@ def cents_to_money(cents: int) -> str:
     return f"{sign}${cents//100}.{cents%100:02d} {CURRENCY}"
 
 
+async def iter_document_lines(bot: Bot, file_id: str) -> AsyncIterator[str]:
+    # Streams the file from Telegram and yields it line by line; only one chunk is held in memory.
+    file = await bot.get_file(file_id)
+    url = bot.session.api.file_url(bot.token, file.file_path)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in bot.session.stream_content(url, timeout=120):
+        tail += decoder.decode(chunk)
+        *lines, tail = tail.split("\n")
+        for line in lines:
+            yield line.rstrip("\r")
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail.rstrip("\r")
+
+
+def csv_first_cell(line: str) -> str:
+    row = next(csv.reader([line]), None)
+    if not row:
+        return ""
+    cell = row[0].strip()
+    return "" if cell.lower() in ("code", "codigo", "código") else cell
+
+
 def main_menu_kb():
     kb = InlineKeyboardBuilder()
     kb.button(text="🛒 Comprar códigos", callback_data="menu:buy")
@@ -74,269 +170,1877 @@ def products_kb(rows: List[Tuple[str, str, int]]):
     return kb.as_markup()
 
 
-class DB:
-    def __init__(self, pool: asyncpg.Pool):
-        self.pool = pool
+def buy_more_kb(sku: str):
+    kb = InlineKeyboardBuilder()
+    for n in BUY_MORE_QTYS:
+        kb.button(text=f"🔁 x{n}", callback_data=f"buy:{sku}:{n}")
+    kb.button(text="⬅️ Menú", callback_data="menu:back")
+    kb.adjust(len(BUY_MORE_QTYS), 1)
+    return kb.as_markup()
 
-    async def init(self):
-        async with self.pool.acquire() as conn:
-            await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id BIGINT PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                balance_cents INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL
-            );
-            CREATE TABLE IF NOT EXISTS products (
-                sku TEXT PRIMARY KEY,
-                name TEXT NOT NULL,
-                price_cents INTEGER NOT NULL,
-                active BOOLEAN NOT NULL DEFAULT TRUE
-            );
-            CREATE TABLE IF NOT EXISTS codes (
-                id BIGSERIAL PRIMARY KEY,
-                sku TEXT NOT NULL REFERENCES products(sku),
-                code TEXT NOT NULL,
-                status TEXT NOT NULL DEFAULT 'available', -- available|delivered
-                created_at TEXT NOT NULL,
-                delivered_at TEXT,
-                buyer_telegram_id BIGINT REFERENCES users(telegram_id),
-                order_id TEXT
-            );
-            CREATE INDEX IF NOT EXISTS idx_codes_sku_status ON codes(sku, status);
-
-            CREATE TABLE IF NOT EXISTS orders (
-                order_id TEXT PRIMARY KEY,
-                telegram_id BIGINT NOT NULL REFERENCES users(telegram_id),
-                sku TEXT NOT NULL REFERENCES products(sku),
-                price_cents INTEGER NOT NULL,
-                status TEXT NOT NULL, -- paid_delivered|failed
-                created_at TEXT NOT NULL,
-                delivered_at TEXT
-            );
-            CREATE INDEX IF NOT EXISTS idx_orders_user_time ON orders(telegram_id, delivered_at);
-
-            CREATE TABLE IF NOT EXISTS balance_moves (
-                id BIGSERIAL PRIMARY KEY,
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+# Order-history position for callback data: delivered_at in epoch microseconds (exact for timestamptz) and
+# order_id, well under Telegram's 64-byte callback_data limit.
+def order_cursor(row) -> str:
+    return f"{(row['delivered_at'] - EPOCH) // timedelta(microseconds=1)}:{row['order_id']}"
+
+
+def parse_order_cursor(cursor: str) -> Tuple[datetime, str]:
+    us, _, order_id = cursor.partition(":")
+    return EPOCH + timedelta(microseconds=int(us)), order_id
+
+
+def orders_text(rows) -> str:
+    if not rows:
+        return "Aún no tienes compras registradas."
+    lines = ["📦 Tus compras (toca una para ver sus códigos):"]
+    for r in rows:
+        lines.append(f"- {fmt_ts(r['delivered_at'])} | {r['sku']} | {cents_to_money(int(r['price_cents']))} | Orden {r['order_id']}")
+    return "\n".join(lines)
+
+
+def orders_kb(rows, has_newer: bool, has_older: bool):
+    kb = InlineKeyboardBuilder()
+    for r in rows:
+        kb.button(text=f"🔑 {r['order_id']} · {r['sku']}", callback_data=f"order:{r['order_id']}")
+    nav = 0
+    if has_newer:
+        kb.button(text="◀️ Más recientes", callback_data=f"ord:prev:{order_cursor(rows[0])}")
+        nav += 1
+    if has_older:
+        kb.button(text="Anteriores ▶️", callback_data=f"ord:next:{order_cursor(rows[-1])}")
+        nav += 1
+    kb.button(text="⬅️ Menú", callback_data="menu:back")
+    kb.adjust(*([1] * len(rows)), *([nav] if nav else []), 1)
+    return kb.as_markup()
+
+
+class PurchaseResult(NamedTuple):
+    status: str  # ok|no_product|inactive|no_user|insufficient_funds|out_of_stock
+    sku: str
+    name: Optional[str]
+    codes: List[str]
+    order_id: Optional[str]
+    quantity: int
+    price_cents: int  # unit price
+    balance_cents: int
+    duplicate: bool = False  # a double tap answered with an earlier order
+
+    @property
+    def total_cents(self) -> int:
+        return self.price_cents * self.quantity
+
+
+def purchase_text(res: PurchaseResult, codes_inline: bool = True) -> str:
+    if res.status == "ok":
+        if res.quantity == 1:
+            return (
+                f"✅ Compra confirmada\n"
+                f"Producto: {res.name}\n"
+                f"Código:\n`{res.codes[0]}`\n\n"
+                f"Orden: `{res.order_id}`\n"
+                f"Saldo restante: {cents_to_money(res.balance_cents)}"
+            )
+        codes = "\n".join(f"`{c}`" for c in res.codes) if codes_inline else "(van en el archivo adjunto)"
+        return (
+            f"✅ Compra confirmada\n"
+            f"Producto: {res.name} x{res.quantity}\n"
+            f"Códigos:\n{codes}\n\n"
+            f"Orden: `{res.order_id}`\n"
+            f"Total: {cents_to_money(res.total_cents)}\n"
+            f"Saldo restante: {cents_to_money(res.balance_cents)}"
+        )
+    if res.status == "no_product":
+        return "Producto no existe."
+    if res.status == "inactive":
+        return "Producto no está disponible."
+    if res.status == "no_user":
+        return "Usuario no registrado. Usa /start."
+    if res.status == "insufficient_funds":
+        faltan = res.total_cents - res.balance_cents
+        return f"❌ Saldo insuficiente. Te faltan {cents_to_money(faltan)}."
+    if res.quantity > 1:
+        return f"⚠️ No hay stock suficiente para {res.quantity} unidades de este producto."
+    return "⚠️ Por el momento no hay stock de este producto."
+
+
+class IngestResult(NamedTuple):
+    inserted: int
+    duplicates: int
+    seconds: float
+
+    @property
+    def rate(self) -> float:
+        return self.inserted / self.seconds if self.seconds > 0 else 0.0
+
+
+def ingest_text(res: IngestResult) -> str:
+    return f"{res.inserted} códigos nuevos, {res.duplicates} duplicados, en {res.seconds:.2f}s ({res.rate:,.0f}/s)"
+
+
+MOVE_LABELS = {"topup": "Recarga", "purchase": "Compra", "admin_adjust": "Ajuste"}
+
+
+def statement_text(rows, title: str) -> str:
+    if not rows:
+        return "No hay movimientos de saldo registrados."
+    lines = [f"{title} (máx. {STATEMENT_ROWS}):"]
+    for r in rows:
+        amount = int(r["amount_cents"])
+        lines.append(
+            f"- {fmt_ts(r['created_at'])} | {MOVE_LABELS.get(r['type'], r['type'])} | "
+            f"{'+' if amount > 0 else ''}{cents_to_money(amount)} | Saldo {cents_to_money(int(r['balance_after_cents']))}"
+        )
+    return "\n".join(lines)
+
+
+async def create_index_concurrently(conn: asyncpg.Connection, name: str, definition: str, unique: bool = False):
+    # An interrupted CONCURRENTLY build leaves an INVALID index behind that IF NOT EXISTS would accept.
+    if await conn.fetchval("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name):
+        await conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+    await conn.execute(f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition}")
+
+
+# Runs DDL that needs an ACCESS EXCLUSIVE lock in one transaction, retried until it gets the lock.
+async def run_with_lock_timeout(conn: asyncpg.Connection, sql: str, table: str):
+    while True:
+        try:
+            async with conn.transaction():
+                # Give up quickly rather than queue every other query behind our ACCESS EXCLUSIVE request.
+                await conn.execute("SET LOCAL lock_timeout = '3s'")
+                await conn.execute(sql)
+            return
+        except asyncpg.LockNotAvailableError:
+            print(f"⏳ {table} ocupada, reintentando…")
+            await asyncio.sleep(1)
+
+
+# Timestamps that older databases still keep as TEXT: table -> (key column, key lower bound, columns).
+LEGACY_TIMESTAMPS = {
+    "users": ("telegram_id", 0, ("created_at", "blocked_at")),
+    "codes": ("id", 0, ("created_at", "delivered_at")),
+    "orders": ("order_id", "", ("created_at", "delivered_at")),
+    "balance_moves": ("id", 0, ("created_at",)),
+    "pending_uploads": ("admin_id", 0, ("started_at",)),
+    "broadcasts": ("id", 0, ("created_at", "finished_at")),
+}
+
+
+# Online TEXT -> TIMESTAMPTZ conversion for databases created before the native columns. Per table: shadow
+# columns filled in TIMESTAMP_BATCH-row transactions (a trigger converts rows that replicas still on the
+# old code write meanwhile), NOT NULL proven with a validated CHECK, then one short lock to swap them in.
+async def convert_legacy_timestamps(conn: asyncpg.Connection):
+    rows = await conn.fetch("""
+        SELECT table_name::TEXT AS tbl, column_name::TEXT AS col, is_nullable = 'YES' AS nullable
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND data_type = 'text'
+          AND (table_name::TEXT, column_name::TEXT) IN (SELECT * FROM unnest($1::TEXT[], $2::TEXT[]))
+        ORDER BY table_name, ordinal_position
+    """, [t for t, (_, _, cols) in LEGACY_TIMESTAMPS.items() for _ in cols],
+        [c for _, (_, _, cols) in LEGACY_TIMESTAMPS.items() for c in cols])
+    pending: Dict[str, List[Tuple[str, bool]]] = {}
+    for r in rows:
+        pending.setdefault(r["tbl"], []).append((r["col"], r["nullable"]))
+    for table, cols in pending.items():
+        await _convert_table_timestamps(conn, table, cols)
+
+
+async def _convert_table_timestamps(conn: asyncpg.Connection, table: str, cols: List[Tuple[str, bool]]):
+    key, last, _ = LEGACY_TIMESTAMPS[table]
+    zone = LEGACY_TIMEZONE.key
+    t0 = time.perf_counter()
+    print(f"⏳ Convirtiendo fechas de {table} a timestamptz…")
+
+    def parsed(col: str) -> str:
+        return f"(NULLIF({col}, '')::timestamp AT TIME ZONE '{zone}')"
+
+    await conn.execute(
+        "".join(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {c}_tz TIMESTAMPTZ;\n" for c, _ in cols) + f"""
+        CREATE OR REPLACE FUNCTION {table}_tz_sync() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            {" ".join(f"NEW.{c}_tz := {parsed('NEW.' + c)};" for c, _ in cols)}
+            RETURN NEW;
+        END;
+        $$;
+        DROP TRIGGER IF EXISTS {table}_tz_sync ON {table};
+        CREATE TRIGGER {table}_tz_sync BEFORE INSERT OR UPDATE ON {table}
+        FOR EACH ROW EXECUTE FUNCTION {table}_tz_sync();
+    """)
+    converted = 0
+    while True:
+        # Keyset walk over the primary key; each batch commits on its own.
+        row = await conn.fetchrow(f"""
+            WITH b AS (
+                SELECT {key} FROM {table} WHERE {key} > $1 ORDER BY {key} LIMIT $2
+            ), u AS (
+                UPDATE {table} t SET {", ".join(f"{c}_tz = {parsed('t.' + c)}" for c, _ in cols)}
+                FROM b WHERE t.{key} = b.{key}
+                RETURNING t.{key}
+            )
+            SELECT max({key}) AS last, COUNT(*) AS n FROM u
+        """, last, TIMESTAMP_BATCH)
+        if not row["n"]:
+            break
+        last = row["last"]
+        converted += row["n"]
+
+    swap = [f"DROP TRIGGER {table}_tz_sync ON {table}", f"DROP FUNCTION {table}_tz_sync()"]
+    for c, nullable in cols:
+        swap += [f"ALTER TABLE {table} DROP COLUMN {c}", f"ALTER TABLE {table} RENAME COLUMN {c}_tz TO {c}"]
+        if not nullable:
+            # VALIDATE scans without blocking writes; SET NOT NULL then trusts the constraint instead of rescanning.
+            await conn.execute(f"""
+                ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {table}_{c}_tz_nn;
+                ALTER TABLE {table} ADD CONSTRAINT {table}_{c}_tz_nn CHECK ({c}_tz IS NOT NULL) NOT VALID;
+            """)
+            await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {table}_{c}_tz_nn")
+            swap += [
+                f"ALTER TABLE {table} ALTER COLUMN {c} SET DEFAULT now(), ALTER COLUMN {c} SET NOT NULL",
+                f"ALTER TABLE {table} DROP CONSTRAINT {table}_{c}_tz_nn",
+            ]
+    await run_with_lock_timeout(conn, ";\n".join(swap), table)
+    await conn.execute(f"ANALYZE {table}")
+    print(f"✅ {table}: {converted} filas convertidas en {time.perf_counter() - t0:.1f}s")
+
+
+def month_start(day: date, months: int = 0) -> datetime:
+    m = day.month - 1 + months
+    return datetime(day.year + m // 12, m % 12 + 1, 1, tzinfo=timezone.utc)
+
+
+# Range partitions of balance_moves as (name, lower, upper), oldest first; lower is None for the partition
+# that holds everything from before partitioning. The DEFAULT partition is left out.
+async def ledger_partitions(conn: asyncpg.Connection) -> List[Tuple[str, Optional[datetime], datetime]]:
+    rows = await conn.fetch("""
+        SELECT c.relname::TEXT AS name,
+               (regexp_match(b.expr, 'FROM \\(''([^'']+)''\\)'))[1]::timestamptz AS lower,
+               (regexp_match(b.expr, 'TO \\(''([^'']+)''\\)'))[1]::timestamptz AS upper
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        CROSS JOIN LATERAL (SELECT pg_get_expr(c.relpartbound, c.oid) AS expr) b
+        WHERE i.inhparent = 'balance_moves'::regclass AND b.expr <> 'DEFAULT'
+        ORDER BY upper
+    """)
+    return [(r["name"], r["lower"], r["upper"]) for r in rows]
+
+
+# Adds the monthly partitions missing between the last one and `months_ahead` months from now. Rows that
+# arrive with no partition land in balance_moves_default; a month they fall in cannot be created until they
+# are moved out, which is reported instead of failing the caller.
+async def ensure_ledger_partitions(conn: asyncpg.Connection, months_ahead: int = LEDGER_MONTHS_AHEAD) -> List[str]:
+    parts = await ledger_partitions(conn)
+    today = datetime.now(timezone.utc).date()
+    start = parts[-1][2] if parts else month_start(today)
+    created = []
+    while start < month_start(today, months_ahead + 1):
+        end = month_start(start.date(), 1)
+        name = f"balance_moves_{start:%Y%m}"
+        try:
+            await run_with_lock_timeout(conn, f"""
+                CREATE TABLE IF NOT EXISTS {name} PARTITION OF balance_moves
+                FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')
+            """, "balance_moves")
+        except asyncpg.CheckViolationError:
+            print(f"⚠️ No se pudo crear {name}: balance_moves_default ya tiene movimientos de ese mes.")
+            break
+        created.append(name)
+        start = end
+    return created
+
+
+# Detaches (does not drop) the partitions whose whole range is older than `months` months.
+async def detach_old_ledger_partitions(conn: asyncpg.Connection, months: int = LEDGER_RETENTION_MONTHS) -> List[str]:
+    if months <= 0:
+        return []
+    cutoff = month_start(datetime.now(timezone.utc).date(), -months)
+    detached = []
+    for name, _, upper in await ledger_partitions(conn):
+        if upper > cutoff:
+            break
+        # CONCURRENTLY is not allowed next to a DEFAULT partition; a plain detach only touches the catalog.
+        await run_with_lock_timeout(conn, f"ALTER TABLE balance_moves DETACH PARTITION {name}", "balance_moves")
+        detached.append(name)
+    return detached
+
+
+# Turns the plain balance_moves into a table partitioned by month without copying it: the existing table
+# becomes the partition for everything before `split`. Its indexes and the CHECK that proves the range are
+# built beforehand without blocking writes, so the swap itself is catalog-only and takes one short lock.
+async def partition_balance_moves(conn: asyncpg.Connection):
+    if not await conn.fetchval("SELECT relkind = 'p' FROM pg_class WHERE oid = 'balance_moves'::regclass"):
+        now = datetime.now(timezone.utc)
+        split = month_start(now.date(), 1)
+        if split - now < timedelta(days=1):
+            split = month_start(now.date(), 2)  # leave room for rows written until the swap
+        await create_index_concurrently(conn, "balance_moves_legacy_key", "balance_moves(id, created_at)", unique=True)
+        await create_index_concurrently(conn, "balance_moves_legacy_user_time", "balance_moves(telegram_id, created_at)")
+        await conn.execute(f"""
+            ALTER TABLE balance_moves DROP CONSTRAINT IF EXISTS balance_moves_legacy_range;
+            ALTER TABLE balance_moves ADD CONSTRAINT balance_moves_legacy_range
+                CHECK (created_at < '{split.isoformat()}') NOT VALID;
+        """)
+        await conn.execute("ALTER TABLE balance_moves VALIDATE CONSTRAINT balance_moves_legacy_range")
+        # The partition key must be part of the primary key; ATTACH reuses the legacy indexes that match
+        # the parent's, and the validated CHECK spares it the scan of the partition.
+        await run_with_lock_timeout(conn, f"""
+            ALTER TABLE balance_moves RENAME TO balance_moves_legacy;
+            ALTER TABLE balance_moves_legacy DROP CONSTRAINT balance_moves_pkey,
+                ADD CONSTRAINT balance_moves_legacy_pkey PRIMARY KEY USING INDEX balance_moves_legacy_key;
+            CREATE TABLE balance_moves (
+                id BIGINT NOT NULL DEFAULT nextval('balance_moves_id_seq'),
                 telegram_id BIGINT NOT NULL REFERENCES users(telegram_id),
                 type TEXT NOT NULL, -- topup|purchase|admin_adjust
                 amount_cents INTEGER NOT NULL,
                 balance_before_cents INTEGER NOT NULL,
                 balance_after_cents INTEGER NOT NULL,
                 ref TEXT,
-                created_at TEXT NOT NULL
-            );
-            """)
+                created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                PRIMARY KEY (id, created_at)
+            ) PARTITION BY RANGE (created_at);
+            ALTER SEQUENCE balance_moves_id_seq OWNED BY balance_moves.id;
+            ALTER TABLE balance_moves ATTACH PARTITION balance_moves_legacy
+                FOR VALUES FROM (MINVALUE) TO ('{split.isoformat()}');
+            ALTER TABLE balance_moves_legacy DROP CONSTRAINT balance_moves_legacy_range;
+            CREATE INDEX idx_balance_moves_user_time ON balance_moves(telegram_id, created_at);
+            CREATE TABLE balance_moves_default PARTITION OF balance_moves DEFAULT;
+        """, "balance_moves")
+    await ensure_ledger_partitions(conn)
+    await conn.execute("ANALYZE balance_moves")
+
+
+# The current purchase_codes(), kept in one place: every migration that installs it runs this text, and a
+# change to it ships as a new migration with sql=PURCHASE_CODES_SQL. Whole purchase in one server-side call,
+# one round trip while the row locks are held; claims p_qty codes with a single SKIP LOCKED select.
+PURCHASE_CODES_SQL = """
+    -- Earlier signatures, and the current one too: CREATE OR REPLACE cannot change the return type.
+    DROP FUNCTION IF EXISTS purchase_code(BIGINT, TEXT, TEXT, TEXT);
+    DROP FUNCTION IF EXISTS purchase_codes(BIGINT, TEXT, INTEGER, TEXT, TEXT);
+    DROP FUNCTION IF EXISTS purchase_codes(BIGINT, TEXT, INTEGER, TEXT, TEXT, DOUBLE PRECISION);
+    DROP FUNCTION IF EXISTS purchase_codes(BIGINT, TEXT, INTEGER, TEXT, DOUBLE PRECISION);
+    CREATE FUNCTION purchase_codes(
+        p_telegram_id BIGINT, p_sku TEXT, p_qty INTEGER, p_order_id TEXT, p_window DOUBLE PRECISION
+    )
+    RETURNS TABLE(
+        result TEXT, product_name TEXT, code_values TEXT[], price INTEGER, balance INTEGER, order_ref TEXT, version BIGINT
+    )
+    LANGUAGE plpgsql AS $$
+    DECLARE
+        v_active BOOLEAN;
+        v_balance INTEGER;
+        v_total INTEGER;
+        v_ids BIGINT[];
+    BEGIN
+        SELECT p.name, p.price_cents, p.active INTO product_name, price, v_active
+        FROM products p WHERE p.sku = p_sku;
+        IF NOT FOUND THEN
+            result := 'no_product'; RETURN NEXT; RETURN;
+        END IF;
+        IF NOT v_active THEN
+            result := 'inactive'; RETURN NEXT; RETURN;
+        END IF;
+
+        IF p_window > 0 THEN
+            -- Takes the guard unless a delivered order holds it from less than p_window seconds ago.
+            INSERT INTO purchase_guards AS g(telegram_id, sku, quantity, order_id)
+            VALUES(p_telegram_id, p_sku, p_qty, p_order_id)
+            ON CONFLICT (telegram_id, sku, quantity) DO UPDATE
+            SET order_id = EXCLUDED.order_id, created_at = EXCLUDED.created_at
+            WHERE g.created_at < EXCLUDED.created_at - make_interval(secs => p_window)
+               OR NOT EXISTS (SELECT 1 FROM orders o WHERE o.order_id = g.order_id)
+            RETURNING g.order_id INTO order_ref;
+            IF NOT FOUND THEN
+                SELECT g.order_id INTO order_ref FROM purchase_guards g
+                WHERE g.telegram_id = p_telegram_id AND g.sku = p_sku AND g.quantity = p_qty;
+                SELECT array_agg(c.code ORDER BY c.id) INTO code_values FROM codes c WHERE c.order_id = order_ref;
+                SELECT u.balance_cents, u.balance_version INTO balance, version
+                FROM users u WHERE u.telegram_id = p_telegram_id;
+                result := 'duplicate'; RETURN NEXT; RETURN;
+            END IF;
+        END IF;
+
+        SELECT u.balance_cents, u.balance_version INTO v_balance, version
+        FROM users u WHERE u.telegram_id = p_telegram_id FOR UPDATE;
+        IF NOT FOUND THEN
+            result := 'no_user'; RETURN NEXT; RETURN;
+        END IF;
+        balance := v_balance;
+        v_total := price * p_qty;
+        IF v_balance < v_total THEN
+            result := 'insufficient_funds'; RETURN NEXT; RETURN;
+        END IF;
+
+        SELECT array_agg(a.id ORDER BY a.id), array_agg(a.code ORDER BY a.id) INTO v_ids, code_values
+        FROM (
+            SELECT c.id, c.code FROM codes c
+            WHERE c.sku = p_sku AND c.status = 'available'
+            ORDER BY c.id ASC
+            LIMIT p_qty
+            FOR UPDATE SKIP LOCKED
+        ) a;
+        IF coalesce(cardinality(v_ids), 0) < p_qty THEN
+            code_values := NULL; result := 'out_of_stock'; RETURN NEXT; RETURN;
+        END IF;
+
+        UPDATE codes
+        SET status = 'delivered', delivered_at = now(), buyer_telegram_id = p_telegram_id, order_id = p_order_id
+        WHERE id = ANY(v_ids);
+        UPDATE product_stock SET available = available - p_qty WHERE sku = p_sku;
+
+        balance := v_balance - v_total;
+        INSERT INTO orders(order_id, telegram_id, sku, price_cents, quantity, status, delivered_at)
+        VALUES(p_order_id, p_telegram_id, p_sku, v_total, p_qty, 'paid_delivered', now());
+        UPDATE users SET balance_cents = balance WHERE telegram_id = p_telegram_id RETURNING balance_version INTO version;
+        INSERT INTO balance_moves(telegram_id, type, amount_cents, balance_before_cents, balance_after_cents, ref)
+        VALUES(p_telegram_id, 'purchase', -v_total, v_balance, balance, 'order:' || p_order_id);
+
+        order_ref := p_order_id;
+        result := 'ok'; RETURN NEXT;
+    END;
+    $$;
+"""
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    sql: str = ""  # one transaction
+    run: Optional[Callable[[asyncpg.Connection], Awaitable[None]]] = None  # batched data changes, own transactions
+    indexes: Tuple[Tuple[str, str], ...] = ()  # (name, "table(columns) [WHERE ...]"), built CONCURRENTLY
+    online: Tuple[str, ...] = ()  # other statements that cannot run in a transaction, run last
+
+
+# Applied in order by DB.init; the version is recorded only after every step succeeded, so each step must be
+# safe to run again. Never edit an applied migration: append a new one (PURCHASE_CODES_SQL is the one shared
+# text, and changing it also means appending a migration that runs it). Versions 1-4 rebuild the schema of
+# deployments that predate schema_version, which is why they use IF NOT EXISTS throughout.
+MIGRATIONS = [
+    Migration(1, "esquema base", sql="""
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            balance_cents INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS products (
+            sku TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            price_cents INTEGER NOT NULL,
+            active BOOLEAN NOT NULL DEFAULT TRUE
+        );
+        CREATE TABLE IF NOT EXISTS codes (
+            id BIGSERIAL PRIMARY KEY,
+            sku TEXT NOT NULL REFERENCES products(sku),
+            code TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'available', -- available|delivered
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            delivered_at TIMESTAMPTZ,
+            buyer_telegram_id BIGINT REFERENCES users(telegram_id),
+            order_id TEXT
+        );
+
+        CREATE TABLE IF NOT EXISTS orders (
+            order_id TEXT PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id),
+            sku TEXT NOT NULL REFERENCES products(sku),
+            price_cents INTEGER NOT NULL,
+            status TEXT NOT NULL, -- paid_delivered|failed
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            delivered_at TIMESTAMPTZ
+        );
+
+        CREATE TABLE IF NOT EXISTS balance_moves (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id),
+            type TEXT NOT NULL, -- topup|purchase|admin_adjust
+            amount_cents INTEGER NOT NULL,
+            balance_before_cents INTEGER NOT NULL,
+            balance_after_cents INTEGER NOT NULL,
+            ref TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+
+        ALTER TABLE orders ADD COLUMN IF NOT EXISTS quantity INTEGER NOT NULL DEFAULT 1;
+
+        -- Available-code counters, maintained by add_codes and purchase_codes().
+        CREATE TABLE IF NOT EXISTS product_stock (
+            sku TEXT PRIMARY KEY REFERENCES products(sku),
+            available INTEGER NOT NULL DEFAULT 0
+        );
+        INSERT INTO product_stock(sku, available)
+        SELECT p.sku, (SELECT COUNT(*) FROM codes c WHERE c.sku = p.sku AND c.status = 'available')
+        FROM products p
+        WHERE NOT EXISTS (SELECT 1 FROM product_stock s WHERE s.sku = p.sku);
+
+        -- Last purchase per (user, sku, quantity): a repeat inside the double-tap window is answered
+        -- with that order instead of buying again. Concurrent taps serialize on this row, not on users.
+        CREATE TABLE IF NOT EXISTS purchase_guards (
+            telegram_id BIGINT NOT NULL,
+            sku TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            order_id TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (telegram_id, sku, quantity)
+        );
+
+        -- Crash-safe staging for /addcodes: pasted codes land here until /done promotes them.
+        CREATE TABLE IF NOT EXISTS pending_uploads (
+            admin_id BIGINT PRIMARY KEY,
+            sku TEXT NOT NULL REFERENCES products(sku),
+            staged INTEGER NOT NULL DEFAULT 0,
+            started_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE TABLE IF NOT EXISTS pending_codes (
+            id BIGSERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            code TEXT NOT NULL
+        );
+
+        -- /broadcast: recipients are walked in telegram_id order and last_telegram_id is the resume point.
+        -- The process holding the lease sends; a crashed owner's broadcast is picked up once it expires.
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ;
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id BIGSERIAL PRIMARY KEY,
+            admin_id BIGINT NOT NULL,
+            text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'running', -- running|done
+            last_telegram_id BIGINT NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            blocked INTEGER NOT NULL DEFAULT 0,
+            owner TEXT,
+            lease_until TIMESTAMPTZ,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+    """, indexes=(
+        ("idx_codes_sku_status", "codes(sku, status)"),
+        ("idx_codes_order", "codes(order_id) WHERE order_id IS NOT NULL"),
+        ("idx_orders_user_time", "orders(telegram_id, delivered_at)"),
+        ("idx_pending_codes_admin", "pending_codes(admin_id)"),
+    )),
+    # Not concurrent on purpose: the duplicate cleanup and the unique index must see the same rows.
+    Migration(2, "códigos únicos por producto", sql="""
+        -- One row per (sku, code): a 16-byte md5 key keeps the unique index compact.
+        -- First creation drops duplicated *available* rows (delivered history is kept) and resyncs stock.
+        DO $$
+        BEGIN
+            IF to_regclass('uq_codes_sku_hash') IS NULL THEN
+                DELETE FROM codes a USING codes b
+                WHERE a.status = 'available' AND a.sku = b.sku AND a.code = b.code AND a.id <> b.id
+                  AND (b.status = 'delivered' OR b.id < a.id);
+                UPDATE product_stock s
+                SET available = (SELECT COUNT(*) FROM codes c WHERE c.sku = s.sku AND c.status = 'available');
+                CREATE UNIQUE INDEX uq_codes_sku_hash ON codes(sku, decode(md5(code), 'hex'));
+            END IF;
+        EXCEPTION WHEN unique_violation THEN
+            RAISE WARNING 'uq_codes_sku_hash not created: the same code was already delivered twice';
+        END;
+        $$;
+    """),
+    # idx_orders_user_time is rebuilt because the conversion drops it along with the TEXT column.
+    Migration(3, "fechas timestamptz", run=convert_legacy_timestamps, indexes=(
+        ("idx_orders_user_time", "orders(telegram_id, delivered_at)"),
+        ("idx_orders_delivered", "orders(delivered_at)"),
+    )),
+    Migration(4, "purchase_codes()", sql=PURCHASE_CODES_SQL),
+    # The claim in purchase_codes() walks this in id order and only ever sees sellable rows: delivered codes
+    # leave it, so its size tracks the stock, not the sales history. Delivering a code is a non-HOT update
+    # that leaves a dead entry behind until vacuum, hence the more eager autovacuum on codes.
+    Migration(5, "índice parcial de códigos disponibles", sql="""
+        ALTER TABLE codes SET (autovacuum_vacuum_scale_factor = 0.01, autovacuum_analyze_scale_factor = 0.02);
+    """, indexes=(
+        ("idx_codes_available", "codes(sku, id) WHERE status = 'available'"),
+    ), online=(
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_codes_sku_status",
+    )),
+    # Cold storage for delivered codes, filled by DB.archive_codes. all_codes is what order lookups read, so it
+    # does not matter which side of the move a code is on. The hash index keeps archived codes out of uploads.
+    Migration(6, "archivo de códigos entregados", sql="""
+        CREATE TABLE IF NOT EXISTS codes_history (
+            id BIGINT PRIMARY KEY,
+            sku TEXT NOT NULL,
+            code TEXT NOT NULL,
+            status TEXT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL,
+            delivered_at TIMESTAMPTZ,
+            buyer_telegram_id BIGINT,
+            order_id TEXT,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE OR REPLACE VIEW all_codes AS
+            SELECT id, sku, code, status, created_at, delivered_at, buyer_telegram_id, order_id FROM codes
+            UNION ALL
+            SELECT id, sku, code, status, created_at, delivered_at, buyer_telegram_id, order_id FROM codes_history;
+    """, indexes=(
+        ("idx_codes_history_order", "codes_history(order_id)"),
+        ("idx_codes_history_hash", "codes_history(sku, decode(md5(code), 'hex'))"),
+        ("idx_codes_delivered", "codes(delivered_at) WHERE status = 'delivered'"),
+    )),
+    # Monthly partitions keep each statement to an index probe per month and let old months leave the
+    # table by detaching them instead of deleting rows. Maintained afterwards by DB.maintain_ledger.
+    Migration(7, "balance_moves particionado por mes", run=partition_balance_moves),
+    # /recargas: one row per applied payment reference, so re-sending a CSV never credits it twice. The ledger
+    # cannot enforce this itself: a unique index on a partitioned table must include created_at.
+    Migration(8, "referencias de recargas", sql="""
+        CREATE TABLE IF NOT EXISTS topup_refs (
+            ref TEXT PRIMARY KEY,
+            telegram_id BIGINT NOT NULL REFERENCES users(telegram_id),
+            amount_cents INTEGER NOT NULL,
+            admin_id BIGINT NOT NULL,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    # Telegram usernames are case-insensitive; admin commands resolve @usuario through this index.
+    Migration(9, "índice de usernames", indexes=(
+        ("idx_users_username_lower", "users(lower(username))"),
+    )),
+    # Every balance change bumps users.balance_version and announces "telegram_id:version:balance" on the
+    # balances channel (BALANCES_CHANNEL), whoever writes it; processes keep a balance only if it is newer than
+    # what they hold. purchase_codes() now also returns the version its balance corresponds to.
+    Migration(10, "versión de saldo", sql="""
+        ALTER TABLE users ADD COLUMN IF NOT EXISTS balance_version BIGINT NOT NULL DEFAULT 0;
+        CREATE OR REPLACE FUNCTION users_balance_version() RETURNS trigger LANGUAGE plpgsql AS $$
+        BEGIN
+            IF NEW.balance_cents IS DISTINCT FROM OLD.balance_cents THEN
+                NEW.balance_version := OLD.balance_version + 1;
+                PERFORM pg_notify('balances', NEW.telegram_id || ':' || NEW.balance_version || ':' || NEW.balance_cents);
+            END IF;
+            RETURN NEW;
+        END;
+        $$;
+        DROP TRIGGER IF EXISTS users_balance_version ON users;
+        CREATE TRIGGER users_balance_version BEFORE UPDATE OF balance_cents ON users
+        FOR EACH ROW EXECUTE FUNCTION users_balance_version();
+    """ + PURCHASE_CODES_SQL),
+    # Order history pages seek to (telegram_id, delivered_at, order_id) and read forwards or backwards, which
+    # leaves the (telegram_id, delivered_at) index redundant.
+    Migration(11, "historial de compras paginado", indexes=(
+        ("idx_orders_user_page", "orders(telegram_id, delivered_at DESC, order_id DESC)"),
+    ), online=(
+        "DROP INDEX CONCURRENTLY IF EXISTS idx_orders_user_time",
+    )),
+    # add_codes and commit_upload depend on uq_codes_sku_hash for ON CONFLICT, which migration 2 skipped
+    # where a code had been sold twice. Later sales of such a code move to codes_history (all_codes still
+    # finds them by order) and the index is built; if it still cannot be, this fails instead of going on.
+    Migration(12, "índice único de códigos obligatorio", sql="""
+        DO $$
+        DECLARE
+            v_archived INTEGER;
+        BEGIN
+            IF to_regclass('uq_codes_sku_hash') IS NULL THEN
+                WITH dup AS (
+                    DELETE FROM codes a USING codes b
+                    WHERE a.status = 'delivered' AND b.status = 'delivered'
+                      AND a.sku = b.sku AND a.code = b.code AND a.id > b.id
+                    RETURNING a.id, a.sku, a.code, a.status, a.created_at, a.delivered_at, a.buyer_telegram_id, a.order_id
+                ), moved AS (
+                    INSERT INTO codes_history(id, sku, code, status, created_at, delivered_at, buyer_telegram_id, order_id)
+                    SELECT * FROM dup
+                    ON CONFLICT (id) DO NOTHING
+                    RETURNING 1
+                )
+                SELECT COUNT(*) INTO v_archived FROM moved;
+                IF v_archived > 0 THEN
+                    RAISE WARNING '% repeated sales of already delivered codes moved to codes_history', v_archived;
+                END IF;
+                DELETE FROM codes a USING codes b
+                WHERE a.status = 'available' AND a.sku = b.sku AND a.code = b.code AND a.id <> b.id
+                  AND (b.status = 'delivered' OR b.id < a.id);
+                UPDATE product_stock s
+                SET available = (SELECT COUNT(*) FROM codes c WHERE c.sku = s.sku AND c.status = 'available');
+                CREATE UNIQUE INDEX uq_codes_sku_hash ON codes(sku, decode(md5(code), 'hex'));
+            END IF;
+        END;
+        $$;
+    """),
+]
 
-    async def upsert_user(self, telegram_id: int, username: Optional[str], first_name: Optional[str]):
+
+class DB:
+    def __init__(self, pool: asyncpg.Pool):
+        self.pool = pool
+        # telegram_id -> (username, first_name) as last written; _dirty holds changes not flushed yet.
+        self._profiles: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        self._dirty: Dict[int, Tuple[Optional[str], Optional[str]]] = {}
+        # LRU of lower(username) -> telegram_id for admin commands, plus the reverse map to invalidate by user.
+        self._usernames: "OrderedDict[str, int]" = OrderedDict()
+        self._username_of: Dict[int, str] = {}
+        # LRU of telegram_id -> (balance_version, balance_cents); see get_balance.
+        self._balances: "OrderedDict[int, Tuple[int, int]]" = OrderedDict()
+        # Active products as (sku, name, price_cents); catalog_version bumps on every reload.
+        self._catalog: List[Tuple[str, str, int]] = []
+        self.catalog_version = 0
+        self._catalog_stale = False
+        self._catalog_task: Optional[asyncio.Task] = None
+        self._dsn = ""
+        self._listener: Optional[asyncpg.Connection] = None
+        self._closing = False
+        self._background: List[asyncio.Task] = []
+        # (telegram_id, sku, qty) or callback query id -> (monotonic time, purchase future)
+        self._recent_buys: Dict[object, Tuple[float, asyncio.Future]] = {}
+        self.double_tap_seconds = DOUBLE_TAP_SECONDS
+
+    # Applies pending MIGRATIONS. On a current schema this is a single SELECT: no DDL, no locks.
+    async def init(self, dsn: str):
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT telegram_id FROM users WHERE telegram_id=$1", telegram_id)
-            if row is None:
-                await conn.execute(
-                    "INSERT INTO users(telegram_id, username, first_name, balance_cents, created_at) VALUES($1,$2,$3,0,$4)",
-                    telegram_id, username, first_name, now_str()
-                )
-            else:
+            if await self._schema_version(conn) >= MIGRATIONS[-1].version:
+                return
+        # Migrations get their own connection without the pool's command_timeout: waiting for another
+        # replica's lock or a long CONCURRENTLY/VALIDATE step is expected here, not a stuck query.
+        conn = await asyncpg.connect(dsn, command_timeout=None)
+        try:
+            # Session-level, so it also covers the steps that run outside a transaction. Other replicas
+            # booting meanwhile wait here and then find the schema current.
+            await conn.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+            try:
+                await conn.execute("""
+                    CREATE TABLE IF NOT EXISTS schema_version (
+                        version INTEGER PRIMARY KEY,
+                        name TEXT NOT NULL,
+                        applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                """)
+                current = await self._schema_version(conn)
+                for migration in MIGRATIONS:
+                    if migration.version > current:
+                        await self._apply_migration(conn, migration)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+        finally:
+            await conn.close()
+
+    @staticmethod
+    async def _schema_version(conn: asyncpg.Connection) -> int:
+        try:
+            return int(await conn.fetchval("SELECT COALESCE(max(version), 0) FROM schema_version"))
+        except asyncpg.UndefinedTableError:
+            return 0
+
+    @staticmethod
+    async def _apply_migration(conn: asyncpg.Connection, migration: Migration):
+        t0 = time.perf_counter()
+        print(f"🛠️ Migración {migration.version}: {migration.name}…")
+        if migration.sql:
+            async with conn.transaction():
+                await conn.execute(migration.sql)
+        if migration.run:
+            await migration.run(conn)
+        for name, definition in migration.indexes:
+            await create_index_concurrently(conn, name, definition)
+        for statement in migration.online:
+            await conn.execute(statement)
+        await conn.execute("INSERT INTO schema_version(version, name) VALUES($1,$2)", migration.version, migration.name)
+        print(f"✅ Migración {migration.version} aplicada en {time.perf_counter() - t0:.1f}s")
+
+    # Only a user's first sighting in this process writes synchronously (the row must exist before a
+    # purchase locks it); later profile changes are queued for flush_profiles and unchanged ones are free.
+    # That first write also clears blocked_at: someone writing to the bot has unblocked it.
+    # Whoever else still holds a username being written loses it (Telegram usernames move between accounts),
+    # and every write is announced on USERNAMES_CHANNEL so all processes drop their cached resolution.
+    async def upsert_user(self, telegram_id: int, username: Optional[str], first_name: Optional[str]):
+        profile = (username, first_name)
+        known = self._profiles.get(telegram_id)
+        if known == profile:
+            return
+        self._forget_username(telegram_id, username)
+        if known is None:
+            async with self.pool.acquire() as conn:
                 await conn.execute(
-                    "UPDATE users SET username=$2, first_name=$3 WHERE telegram_id=$1",
-                    telegram_id, username, first_name
+                    """WITH up AS (
+                           INSERT INTO users(telegram_id, username, first_name, balance_cents) VALUES($1,$2,$3,0)
+                           ON CONFLICT (telegram_id) DO UPDATE
+                           SET username=EXCLUDED.username, first_name=EXCLUDED.first_name, blocked_at=NULL
+                           WHERE (users.username, users.first_name) IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name)
+                              OR users.blocked_at IS NOT NULL
+                           RETURNING telegram_id, username
+                       ), freed AS (
+                           UPDATE users o SET username = NULL FROM up
+                           WHERE lower(o.username) = lower(up.username) AND o.telegram_id <> up.telegram_id
+                       )
+                       SELECT pg_notify($4, up.telegram_id || ':' || COALESCE(up.username, '')) FROM up""",
+                    telegram_id, username, first_name, USERNAMES_CHANNEL
                 )
+            self._profiles[telegram_id] = profile
+            return
+        self._profiles[telegram_id] = profile
+        self._dirty[telegram_id] = profile
 
+    async def flush_profiles(self):
+        if not self._dirty:
+            return
+        batch, self._dirty = self._dirty, {}
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute("""
+                    WITH up AS (
+                        INSERT INTO users(telegram_id, username, first_name, balance_cents)
+                        SELECT t.telegram_id, t.username, t.first_name, 0
+                        FROM unnest($1::BIGINT[], $2::TEXT[], $3::TEXT[]) AS t(telegram_id, username, first_name)
+                        ON CONFLICT (telegram_id) DO UPDATE
+                        SET username=EXCLUDED.username, first_name=EXCLUDED.first_name, blocked_at=NULL
+                        WHERE (users.username, users.first_name) IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name)
+                           OR users.blocked_at IS NOT NULL
+                        RETURNING telegram_id, username
+                    ), freed AS (
+                        UPDATE users o SET username = NULL FROM up
+                        WHERE lower(o.username) = lower(up.username) AND o.telegram_id <> ALL($1::BIGINT[])
+                    )
+                    SELECT pg_notify($4, up.telegram_id || ':' || COALESCE(up.username, '')) FROM up
+                """, list(batch), [p[0] for p in batch.values()], [p[1] for p in batch.values()], USERNAMES_CHANNEL)
+        except Exception:
+            # Re-queue whatever was not superseded meanwhile, then let the caller report it.
+            for tid, profile in batch.items():
+                self._dirty.setdefault(tid, profile)
+            raise
+
+    async def run_profile_flusher(self):
+        while True:
+            await asyncio.sleep(PROFILE_FLUSH_SECONDS)
+            try:
+                await self.flush_profiles()
+            except Exception as e:
+                print(f"⚠️ Error guardando perfiles: {e}")
+
+    # Moves delivered codes older than ARCHIVE_AFTER_DAYS into codes_history, ARCHIVE_BATCH rows per statement.
+    # Purchases only lock available rows and the batch skips locked ones, so neither side waits on the other.
+    # Returns the number of codes moved, or None if another process holds the archive lock.
+    async def archive_codes(self, older_than_days: int = ARCHIVE_AFTER_DAYS) -> Optional[int]:
+        async with self.pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('archive_codes'))"):
+                return None
+            try:
+                total = 0
+                while True:
+                    moved = await conn.fetchval("""
+                        WITH batch AS (
+                            SELECT id FROM codes
+                            WHERE status = 'delivered' AND delivered_at < now() - make_interval(days => $1)
+                            ORDER BY delivered_at
+                            LIMIT $2
+                            FOR UPDATE SKIP LOCKED
+                        ), moved AS (
+                            DELETE FROM codes c USING batch b WHERE c.id = b.id
+                            RETURNING c.id, c.sku, c.code, c.status, c.created_at, c.delivered_at, c.buyer_telegram_id, c.order_id
+                        ), ins AS (
+                            INSERT INTO codes_history(id, sku, code, status, created_at, delivered_at, buyer_telegram_id, order_id)
+                            SELECT * FROM moved
+                            RETURNING 1
+                        )
+                        SELECT COUNT(*)::INTEGER FROM ins
+                    """, older_than_days, ARCHIVE_BATCH)
+                    total += moved
+                    if moved < ARCHIVE_BATCH:
+                        return total
+                    await asyncio.sleep(0.05)  # between batches, let autovacuum and other sessions breathe
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('archive_codes'))")
+
+    async def run_archiver(self):
+        while True:
+            await asyncio.sleep(ARCHIVE_INTERVAL_SECONDS)
+            try:
+                moved = await self.archive_codes()
+                if moved:
+                    print(f"🗄️ {moved} códigos entregados pasaron a codes_history.")
+            except Exception as e:
+                print(f"⚠️ Error archivando códigos: {e}")
+
+    # Creates upcoming balance_moves partitions and detaches expired ones; one process at a time.
+    async def maintain_ledger(self) -> Optional[Tuple[List[str], List[str]]]:
+        async with self.pool.acquire() as conn:
+            if not await conn.fetchval("SELECT pg_try_advisory_lock(hashtext('ledger_partitions'))"):
+                return None
+            try:
+                return await ensure_ledger_partitions(conn), await detach_old_ledger_partitions(conn)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock(hashtext('ledger_partitions'))")
+
+    async def run_ledger_maintenance(self):
+        while True:
+            try:
+                res = await self.maintain_ledger()
+                if res and res[0]:
+                    print(f"🗓️ Particiones nuevas de balance_moves: {', '.join(res[0])}")
+                if res and res[1]:
+                    print(f"🗄️ Particiones separadas de balance_moves (siguen como tablas): {', '.join(res[1])}")
+            except Exception as e:
+                print(f"⚠️ Error manteniendo particiones de balance_moves: {e}")
+            await asyncio.sleep(LEDGER_MAINTENANCE_SECONDS)
+
+    # Latest moves of a user, newest first: a backward scan of idx_balance_moves_user_time in each monthly
+    # partition merged until `limit` rows, so its cost does not grow with the ledger.
+    async def statement(self, telegram_id: int, limit: int = STATEMENT_ROWS) -> List[asyncpg.Record]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetch("""
+                SELECT created_at, type, amount_cents, balance_after_cents, ref
+                FROM balance_moves
+                WHERE telegram_id=$1
+                ORDER BY created_at DESC
+                LIMIT $2
+            """, telegram_id, limit)
+
+    # Served from memory while the LISTEN connection is up: every balance change, from any process, arrives on
+    # BALANCES_CHANNEL, and this process's own writes are stored from their RETURNING values before that.
+    # Without the listener a cached value could miss another replica's write, so it is not trusted.
     async def get_balance(self, telegram_id: int) -> int:
+        if self._listener is not None and not self._listener.is_closed():
+            cached = self._balances.get(telegram_id)
+            if cached is not None:
+                self._balances.move_to_end(telegram_id)
+                return cached[1]
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT balance_cents FROM users WHERE telegram_id=$1", telegram_id)
-            return int(row["balance_cents"]) if row else 0
+            row = await conn.fetchrow("SELECT balance_cents, balance_version FROM users WHERE telegram_id=$1", telegram_id)
+        if not row:
+            return 0
+        self._remember_balance(telegram_id, row["balance_version"], row["balance_cents"])
+        return int(row["balance_cents"])
+
+    # Keeps a balance unless a newer version is already known; versions make the order of RETURNING values
+    # and notifications irrelevant.
+    def _remember_balance(self, telegram_id: int, version: Optional[int], balance: Optional[int]):
+        if version is None or balance is None:
+            return
+        cached = self._balances.get(telegram_id)
+        if cached is not None and cached[0] >= version:
+            return
+        self._balances[telegram_id] = (int(version), int(balance))
+        self._balances.move_to_end(telegram_id)
+        if len(self._balances) > BALANCE_CACHE_SIZE:
+            self._balances.popitem(last=False)
+
+    def _on_balance_notify(self, _conn, _pid, _channel, payload: str):
+        tid, version, balance = payload.split(":")
+        self._remember_balance(int(tid), int(version), int(balance))
 
+    # Case-insensitive, through idx_users_username_lower; found ids are cached (misses are not, so a user who
+    # just ran /start resolves right away). Should two rows still share a name, the newest account wins.
     async def user_id_by_username(self, username: str) -> Optional[int]:
-        u = username.lstrip("@").strip()
+        key = username.lstrip("@").strip().lower()
+        tid = self._usernames.get(key)
+        if tid is not None:
+            self._usernames.move_to_end(key)
+            return tid
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT telegram_id FROM users WHERE username=$1", u)
-            return int(row["telegram_id"]) if row else None
-
-    async def set_balance_with_move(self, telegram_id: int, new_balance: int, move_type: str, amount_cents: int, ref: str = ""):
+            tid = await conn.fetchval(
+                "SELECT telegram_id FROM users WHERE lower(username)=$1 ORDER BY created_at DESC LIMIT 1", key
+            )
+        if tid is None:
+            return None
+        tid = int(tid)
+        self._forget_username(tid, None)
+        self._usernames[key] = tid
+        self._username_of[tid] = key
+        if len(self._usernames) > USERNAME_CACHE_SIZE:
+            _, oldest = self._usernames.popitem(last=False)
+            self._username_of.pop(oldest, None)
+        return tid
+
+    # Drops what the cache knows about this user and about the username they now have.
+    def _forget_username(self, telegram_id: int, username: Optional[str]):
+        key = self._username_of.pop(telegram_id, None)
+        if key is not None:
+            self._usernames.pop(key, None)
+        if username:
+            tid = self._usernames.pop(username.lower(), None)
+            if tid is not None:
+                self._username_of.pop(tid, None)
+
+    def _on_username_notify(self, _conn, _pid, _channel, payload: str):
+        tid, _, username = payload.partition(":")
+        self._forget_username(int(tid), username or None)
+
+    def _on_blocked_notify(self, _conn, _pid, _channel, payload: str):
+        self._profiles.pop(int(payload), None)
+
+    # Adds `delta` (negative to charge) and writes the ledger row in one statement, relative to whatever the
+    # balance is when the row lock is taken, so a purchase committing meanwhile is never overwritten.
+    # Returns (before, after) as applied, or None if the user does not exist.
+    async def adjust_balance(self, telegram_id: int, delta: int, move_type: str, ref: str = "") -> Optional[Tuple[int, int]]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                WITH u AS (
+                    UPDATE users SET balance_cents = balance_cents + $2 WHERE telegram_id=$1
+                    RETURNING balance_cents - $2 AS before, balance_cents AS after, balance_version AS version
+                ), m AS (
+                    INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref)
+                    SELECT $1, $3, $2, before, after, $4 FROM u
+                )
+                SELECT before, after, version FROM u
+            """, telegram_id, int(delta), move_type, ref)
+        if not row:
+            return None
+        self._remember_balance(telegram_id, row["version"], row["after"])
+        return int(row["before"]), int(row["after"])
+
+    # username (lowercase, no @) -> telegram_id for every known username in one query.
+    async def resolve_usernames(self, usernames: List[str]) -> Dict[str, int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT DISTINCT ON (lower(username)) lower(username) AS username, telegram_id
+                FROM users WHERE lower(username) = ANY($1::TEXT[])
+                ORDER BY lower(username), created_at DESC
+            """, list({u.lstrip("@").strip().lower() for u in usernames}))
+            return {r["username"]: int(r["telegram_id"]) for r in rows}
+
+    # Credits (ref, telegram_id, cents) in one transaction. A ref already in topup_refs is skipped; the rest
+    # are added per user in a single UPDATE, with one ledger row each carrying the running balance in input
+    # order. Returns ref -> balance after that credit for the refs applied now. Refs must be unique in `credits`.
+    async def apply_topups(self, admin_id: int, credits: List[Tuple[str, int, int]]) -> Dict[str, int]:
+        if not credits:
+            return {}
+        refs = [c[0] for c in credits]
+        ids = [c[1] for c in credits]
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                row = await conn.fetchrow("SELECT balance_cents FROM users WHERE telegram_id=$1 FOR UPDATE", telegram_id)
-                if not row:
-                    return
-                before = int(row["balance_cents"])
-                after = int(new_balance)
-                await conn.execute("UPDATE users SET balance_cents=$2 WHERE telegram_id=$1", telegram_id, after)
+                # Same lock order in every import, so two of them touching the same users cannot deadlock.
                 await conn.execute(
-                    """INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref,created_at)
-                       VALUES($1,$2,$3,$4,$5,$6,$7)""",
-                    telegram_id, move_type, int(amount_cents), before, after, ref, now_str()
+                    "SELECT 1 FROM users WHERE telegram_id = ANY($1::BIGINT[]) ORDER BY telegram_id FOR UPDATE",
+                    list(set(ids)),
                 )
+                rows = await conn.fetch("""
+                    WITH input AS (
+                        SELECT * FROM unnest($1::TEXT[], $2::BIGINT[], $3::INTEGER[])
+                            WITH ORDINALITY AS t(ref, telegram_id, amount_cents, n)
+                    ), claimed AS (
+                        INSERT INTO topup_refs(ref, telegram_id, amount_cents, admin_id)
+                        SELECT ref, telegram_id, amount_cents, $4 FROM input
+                        ON CONFLICT (ref) DO NOTHING
+                        RETURNING ref
+                    ), applied AS (
+                        SELECT i.*,
+                               SUM(i.amount_cents) OVER (PARTITION BY i.telegram_id ORDER BY i.n) AS running,
+                               SUM(i.amount_cents) OVER (PARTITION BY i.telegram_id) AS total
+                        FROM input i JOIN claimed c USING (ref)
+                    ), u AS (
+                        UPDATE users SET balance_cents = users.balance_cents + a.total
+                        FROM (SELECT DISTINCT telegram_id, total FROM applied) a
+                        WHERE users.telegram_id = a.telegram_id
+                        RETURNING users.telegram_id, users.balance_cents - a.total AS before,
+                                  users.balance_cents AS balance, users.balance_version AS version
+                    ), moves AS (
+                        INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref)
+                        SELECT a.telegram_id, 'topup', a.amount_cents,
+                               u.before + a.running - a.amount_cents, u.before + a.running, 'recarga:' || a.ref
+                        FROM applied a JOIN u USING (telegram_id)
+                    )
+                    SELECT a.ref, a.telegram_id, u.before + a.running AS after, u.balance, u.version
+                    FROM applied a JOIN u USING (telegram_id)
+                """, refs, ids, [c[2] for c in credits], admin_id)
+        for r in rows:
+            self._remember_balance(int(r["telegram_id"]), r["version"], r["balance"])
+        return {r["ref"]: int(r["after"]) for r in rows}
 
     async def ensure_product(self, sku: str, name: Optional[str] = None, price_cents: Optional[int] = None):
         async with self.pool.acquire() as conn:
             row = await conn.fetchrow("SELECT sku FROM products WHERE sku=$1", sku)
             if row is None:
-                await conn.execute(
-                    "INSERT INTO products(sku,name,price_cents,active) VALUES($1,$2,$3,TRUE)",
-                    sku, name or sku, int(price_cents or 0)
-                )
+                async with conn.transaction():
+                    await conn.execute(
+                        "INSERT INTO products(sku,name,price_cents,active) VALUES($1,$2,$3,TRUE)",
+                        sku, name or sku, int(price_cents or 0)
+                    )
+                    await conn.execute("INSERT INTO product_stock(sku, available) VALUES($1,0) ON CONFLICT DO NOTHING", sku)
+                    await conn.execute("SELECT pg_notify($1, $2)", CATALOG_CHANNEL, sku)
 
-    async def set_price(self, sku: str, price_cents: int):
+    # The catalog setters notify every bot process (see start_listener) in the same statement.
+    async def _update_product(self, sql: str, sku: str, value) -> bool:
         async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE products SET price_cents=$2 WHERE sku=$1", sku, int(price_cents))
+            rows = await conn.fetch(
+                f"WITH u AS ({sql} RETURNING sku) SELECT pg_notify($3, sku) FROM u", sku, value, CATALOG_CHANNEL
+            )
+            return bool(rows)
 
-    async def set_name(self, sku: str, name: str):
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE products SET name=$2 WHERE sku=$1", sku, name)
+    async def set_price(self, sku: str, price_cents: int) -> bool:
+        return await self._update_product("UPDATE products SET price_cents=$2 WHERE sku=$1", sku, int(price_cents))
 
-    async def set_active(self, sku: str, active: bool):
-        async with self.pool.acquire() as conn:
-            await conn.execute("UPDATE products SET active=$2 WHERE sku=$1", sku, bool(active))
+    async def set_name(self, sku: str, name: str) -> bool:
+        return await self._update_product("UPDATE products SET name=$2 WHERE sku=$1", sku, name)
 
-    async def list_active_products(self) -> List[Tuple[str, str, int]]:
+    async def set_active(self, sku: str, active: bool) -> bool:
+        return await self._update_product("UPDATE products SET active=$2 WHERE sku=$1", sku, bool(active))
+
+    async def load_catalog(self):
         async with self.pool.acquire() as conn:
             rows = await conn.fetch("SELECT sku, name, price_cents FROM products WHERE active=TRUE ORDER BY name ASC")
-            return [(r["sku"], r["name"], int(r["price_cents"])) for r in rows]
+        self._catalog = [(r["sku"], r["name"], int(r["price_cents"])) for r in rows]
+        self.catalog_version += 1
+
+    # Served from memory once loaded; the listener reloads it when any process changes a product.
+    async def list_active_products(self) -> List[Tuple[str, str, int]]:
+        if not self.catalog_version:
+            await self.load_catalog()
+        return self._catalog
+
+    def _on_catalog_notify(self, *_):
+        self._catalog_stale = True
+        if self._catalog_task is None or self._catalog_task.done():
+            self._catalog_task = asyncio.create_task(self._refresh_catalog())
+
+    async def _refresh_catalog(self):
+        # Coalesces bursts of notifications (e.g. several /precio in a row) into few reloads.
+        while self._catalog_stale:
+            self._catalog_stale = False
+            try:
+                await self.load_catalog()
+            except Exception as e:
+                print(f"⚠️ Error recargando catálogo: {e}")
+                await asyncio.sleep(LISTEN_RETRY_SECONDS)
+                self._catalog_stale = True
+
+    async def start_listener(self, dsn: str):
+        self._dsn = dsn
+        # LISTEN first, so a change committed while the snapshot loads still triggers a reload.
+        await self._connect_listener()
+        await self.load_catalog()
+
+    async def _connect_listener(self):
+        while not self._closing:
+            try:
+                conn = await asyncpg.connect(self._dsn)
+                await conn.add_listener(CATALOG_CHANNEL, self._on_catalog_notify)
+                await conn.add_listener(USERNAMES_CHANNEL, self._on_username_notify)
+                await conn.add_listener(BALANCES_CHANNEL, self._on_balance_notify)
+                await conn.add_listener(BLOCKED_CHANNEL, self._on_blocked_notify)
+                conn.add_termination_listener(self._on_listener_lost)
+                self._listener = conn
+                return
+            except (OSError, asyncpg.PostgresError) as e:
+                print(f"⚠️ LISTEN no disponible, reintentando: {e}")
+                await asyncio.sleep(LISTEN_RETRY_SECONDS)
+
+    def _on_listener_lost(self, _conn):
+        if self._closing:
+            return
+        print("⚠️ Conexión LISTEN perdida, reconectando…")
+        asyncio.create_task(self._relisten())
+
+    async def _relisten(self):
+        await self._connect_listener()
+        # Notifications sent while disconnected are lost: reload unconditionally.
+        self._on_catalog_notify()
+        self._usernames.clear()
+        self._username_of.clear()
+        self._balances.clear()
+        self._profiles.clear()
+
+    async def stop_listener(self):
+        self._closing = True
+        if self._listener is not None:
+            await self._listener.close()
+
+    def start_background(self):
+        self._background.append(asyncio.create_task(self.run_profile_flusher()))
+        self._background.append(asyncio.create_task(self.run_archiver()))
+        self._background.append(asyncio.create_task(self.run_ledger_maintenance()))
+
+    async def close(self):
+        for task in self._background:
+            task.cancel()
+        await self.stop_listener()
+        await self.flush_profiles()
+        await self.pool.close()
 
     async def stock_for_sku(self, sku: str) -> int:
         async with self.pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT COUNT(*) AS c FROM codes WHERE sku=$1 AND status='available'", sku)
-            return int(row["c"]) if row else 0
+            row = await conn.fetchrow("SELECT available FROM product_stock WHERE sku=$1", sku)
+            return int(row["available"]) if row else 0
 
-    async def add_codes(self, sku: str, codes: List[str]) -> int:
-        await self.ensure_product(sku, name=sku, price_cents=0)
+    async def stock_all(self) -> List[Tuple[str, str, bool, int]]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT p.sku, p.name, p.active, COALESCE(s.available, 0) AS available
+                FROM products p
+                LEFT JOIN product_stock s ON s.sku = p.sku
+                ORDER BY p.name ASC
+            """)
+            return [(r["sku"], r["name"], bool(r["active"]), int(r["available"])) for r in rows]
+
+    # Recomputes every counter from codes; returns the (sku, counter, real) rows that had drifted.
+    async def recount_stock(self) -> List[Tuple[str, int, int]]:
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                n = 0
-                for c in codes:
-                    c = c.strip()
-                    if not c:
-                        continue
-                    await conn.execute(
-                        "INSERT INTO codes(sku, code, status, created_at) VALUES($1,$2,'available',$3)",
-                        sku, c, now_str()
+                # Blocks purchases/ingest (they update product_stock) so the count and the overwrite agree.
+                await conn.execute("LOCK TABLE product_stock IN SHARE ROW EXCLUSIVE MODE")
+                rows = await conn.fetch("""
+                    WITH actual AS (
+                        SELECT p.sku, COUNT(c.id)::INTEGER AS n
+                        FROM products p
+                        LEFT JOIN codes c ON c.sku = p.sku AND c.status = 'available'
+                        GROUP BY p.sku
+                    ), fixed AS (
+                        INSERT INTO product_stock(sku, available)
+                        SELECT sku, n FROM actual
+                        ON CONFLICT (sku) DO UPDATE SET available = EXCLUDED.available
+                        WHERE product_stock.available <> EXCLUDED.available
                     )
-                    n += 1
-                return n
-
-    async def deliver_purchase(self, telegram_id: int, sku: str) -> Tuple[bool, str]:
+                    SELECT a.sku, s.available AS counter, a.n AS real
+                    FROM actual a
+                    LEFT JOIN product_stock s ON s.sku = a.sku
+                    WHERE s.available IS DISTINCT FROM a.n
+                    ORDER BY a.sku
+                """)
+        return [(r["sku"], int(r["counter"] or 0), int(r["real"])) for r in rows]
+
+    async def add_codes(self, sku: str, codes: List[str]) -> IngestResult:
+        await self.ensure_product(sku, name=sku, price_cents=0)
+        t0 = time.perf_counter()
+        seen = set()
+        unique: List[str] = []
+        for c in codes:
+            c = c.strip()
+            if c and c not in seen:
+                seen.add(c)
+                unique.append(c)
+        dupes = sum(1 for c in codes if c.strip()) - len(unique)
+        n = 0
         async with self.pool.acquire() as conn:
-            prod = await conn.fetchrow("SELECT name, price_cents, active FROM products WHERE sku=$1", sku)
-        if not prod:
-            return False, "Producto no existe."
-        if not bool(prod["active"]):
-            return False, "Producto no está disponible."
-
-        name = prod["name"]
-        price_cents = int(prod["price_cents"])
-
+            # One COPY into a temp stage + one set-based insert per chunk, each in its own short transaction.
+            # ON CONFLICT against uq_codes_sku_hash skips codes that are already in the table, NOT EXISTS
+            # the ones already sold and archived.
+            for i in range(0, len(unique), INGEST_CHUNK):
+                records = [(c,) for c in unique[i:i + INGEST_CHUNK]]
+                async with conn.transaction():
+                    await conn.execute("CREATE TEMP TABLE IF NOT EXISTS codes_stage (code TEXT NOT NULL) ON COMMIT DELETE ROWS")
+                    await conn.copy_records_to_table("codes_stage", records=records, columns=["code"])
+                    inserted = await conn.fetchval("""
+                        WITH ins AS (
+                            INSERT INTO codes(sku, code, status)
+                            SELECT $1, s.code, 'available' FROM codes_stage s
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM codes_history h
+                                WHERE h.sku = $1 AND decode(md5(h.code), 'hex') = decode(md5(s.code), 'hex')
+                            )
+                            ON CONFLICT (sku, (decode(md5(code), 'hex'))) DO NOTHING
+                            RETURNING 1
+                        ), bump AS (
+                            INSERT INTO product_stock(sku, available)
+                            SELECT $1, (SELECT COUNT(*) FROM ins)
+                            ON CONFLICT (sku) DO UPDATE SET available = product_stock.available + EXCLUDED.available
+                        )
+                        SELECT COUNT(*)::INTEGER FROM ins
+                    """, sku)
+                n += inserted
+                dupes += len(records) - inserted
+        return IngestResult(inserted=n, duplicates=dupes, seconds=time.perf_counter() - t0)
+
+    async def start_upload(self, admin_id: int, sku: str) -> int:
         async with self.pool.acquire() as conn:
             async with conn.transaction():
-                u = await conn.fetchrow("SELECT balance_cents FROM users WHERE telegram_id=$1 FOR UPDATE", telegram_id)
-                if not u:
-                    return False, "Usuario no registrado. Usa /start."
-                balance = int(u["balance_cents"])
-
-                if balance < price_cents:
-                    faltan = price_cents - balance
-                    return False, f"❌ Saldo insuficiente. Te faltan {cents_to_money(faltan)}."
-
-                code_row = await conn.fetchrow("""
-                    SELECT id, code FROM codes
-                    WHERE sku=$1 AND status='available'
-                    ORDER BY id ASC
-                    LIMIT 1
-                    FOR UPDATE SKIP LOCKED
-                """, sku)
-
-                if not code_row:
-                    return False, "⚠️ Por el momento no hay stock de este producto."
-
-                code_id = int(code_row["id"])
-                code_value = code_row["code"]
-
-                order_id = uuid.uuid4().hex[:10].upper()
-                delivered_at = now_str()
-                new_balance = balance - price_cents
+                dropped = await conn.fetchval(
+                    "SELECT staged FROM pending_uploads WHERE admin_id=$1 FOR UPDATE", admin_id
+                )
+                await conn.execute("DELETE FROM pending_codes WHERE admin_id=$1", admin_id)
+                await conn.execute(
+                    """INSERT INTO pending_uploads(admin_id, sku, staged) VALUES($1,$2,0)
+                       ON CONFLICT (admin_id) DO UPDATE SET sku=EXCLUDED.sku, staged=0, started_at=EXCLUDED.started_at""",
+                    admin_id, sku
+                )
+        return int(dropped or 0)
 
-                await conn.execute("""
-                    UPDATE codes
-                    SET status='delivered', delivered_at=$2, buyer_telegram_id=$3, order_id=$4
-                    WHERE id=$1
-                """, code_id, delivered_at, telegram_id, order_id)
+    async def pending_upload(self, admin_id: int) -> Optional[Tuple[str, int]]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT sku, staged FROM pending_uploads WHERE admin_id=$1", admin_id)
+            return (row["sku"], int(row["staged"])) if row else None
 
-                await conn.execute("""
-                    INSERT INTO orders(order_id, telegram_id, sku, price_cents, status, created_at, delivered_at)
-                    VALUES($1,$2,$3,$4,'paid_delivered',$5,$5)
-                """, order_id, telegram_id, sku, price_cents, delivered_at)
+    # Appends codes to the admin's open upload; returns (sku, staged total) or None if there is none.
+    async def stage_codes(self, admin_id: int, codes: List[str]) -> Optional[Tuple[str, int]]:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow(
+                    "UPDATE pending_uploads SET staged = staged + $2 WHERE admin_id=$1 RETURNING sku, staged",
+                    admin_id, len(codes)
+                )
+                if not row:
+                    return None
+                await conn.copy_records_to_table(
+                    "pending_codes", records=[(admin_id, c) for c in codes], columns=["admin_id", "code"]
+                )
+        return row["sku"], int(row["staged"])
 
-                await conn.execute("UPDATE users SET balance_cents=$2 WHERE telegram_id=$1", telegram_id, new_balance)
-                await conn.execute("""
-                    INSERT INTO balance_moves(telegram_id,type,amount_cents,balance_before_cents,balance_after_cents,ref,created_at)
-                    VALUES($1,'purchase',$2,$3,$4,$5,$6)
-                """, telegram_id, -price_cents, balance, new_balance, f"order:{order_id}", delivered_at)
+    # Moves the staged codes into codes with one set-based statement; returns None if there is no upload.
+    async def commit_upload(self, admin_id: int) -> Optional[Tuple[str, IngestResult]]:
+        t0 = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Lock first so a paste committing concurrently is either fully in or waits for the next upload.
+                if not await conn.fetchval("SELECT 1 FROM pending_uploads WHERE admin_id=$1 FOR UPDATE", admin_id):
+                    return None
+                row = await conn.fetchrow("""
+                    WITH up AS (
+                        DELETE FROM pending_uploads WHERE admin_id = $1 RETURNING sku
+                    ), staged AS (
+                        DELETE FROM pending_codes WHERE admin_id = $1 RETURNING id, code
+                    ), ins AS (
+                        -- Staging ids follow paste order; inserting in that order keeps FIFO claiming by codes.id.
+                        INSERT INTO codes(sku, code, status)
+                        SELECT up.sku, staged.code, 'available' FROM staged CROSS JOIN up
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM codes_history h
+                            WHERE h.sku = up.sku AND decode(md5(h.code), 'hex') = decode(md5(staged.code), 'hex')
+                        )
+                        ORDER BY staged.id
+                        ON CONFLICT (sku, (decode(md5(code), 'hex'))) DO NOTHING
+                        RETURNING 1
+                    ), bump AS (
+                        INSERT INTO product_stock(sku, available)
+                        SELECT up.sku, (SELECT COUNT(*) FROM ins) FROM up
+                        ON CONFLICT (sku) DO UPDATE SET available = product_stock.available + EXCLUDED.available
+                    )
+                    SELECT (SELECT sku FROM up) AS sku,
+                           (SELECT COUNT(*) FROM staged)::INTEGER AS staged,
+                           (SELECT COUNT(*) FROM ins)::INTEGER AS inserted
+                """, admin_id)
+        if row["sku"] is None:
+            return None
+        inserted = int(row["inserted"])
+        return row["sku"], IngestResult(
+            inserted=inserted, duplicates=int(row["staged"]) - inserted, seconds=time.perf_counter() - t0
+        )
 
-        return True, (
-            f"✅ Compra confirmada\n"
-            f"Producto: {name}\n"
-            f"Código:\n`{code_value}`\n\n"
-            f"Orden: `{order_id}`\n"
-            f"Saldo restante: {cents_to_money(new_balance)}"
+    async def discard_upload(self, admin_id: int) -> Optional[Tuple[str, int]]:
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow("DELETE FROM pending_uploads WHERE admin_id=$1 RETURNING sku, staged", admin_id)
+                await conn.execute("DELETE FROM pending_codes WHERE admin_id=$1", admin_id)
+        return (row["sku"], int(row["staged"])) if row else None
+
+    # Double taps: a repeat of (user, sku, quantity) inside double_tap_seconds, or a redelivered callback query,
+    # awaits the first call's result here and never reaches the DB. purchase_guards covers other processes.
+    async def deliver_purchase(self, telegram_id: int, sku: str, quantity: int = 1,
+                               request_id: Optional[str] = None) -> PurchaseResult:
+        keys = [(telegram_id, sku, int(quantity))] + ([request_id] if request_id else [])
+        now = time.monotonic()
+        for key in keys:
+            hit = self._recent_buys.get(key)
+            if hit and now - hit[0] < self.double_tap_seconds:
+                return (await asyncio.shield(hit[1]))._replace(duplicate=True)
+        if len(self._recent_buys) > 10000:
+            self._recent_buys = {k: v for k, v in self._recent_buys.items() if now - v[0] < self.double_tap_seconds}
+        fut = asyncio.get_running_loop().create_future()
+        for key in keys:
+            self._recent_buys[key] = (now, fut)
+        try:
+            res = await self._purchase(telegram_id, sku, int(quantity))
+        except BaseException as e:
+            for key in keys:
+                self._recent_buys.pop(key, None)
+            if isinstance(e, Exception):
+                fut.set_exception(e)
+                fut.exception()  # retrieved: no one may be waiting on it
+            else:
+                fut.cancel()
+            raise
+        if res.status != "ok":
+            # Only in-flight and successful buys are single-flighted: after a failure (no funds, no stock) an
+            # immediate retry must reach the DB, whose guard lets failed attempts through as well.
+            for key in keys:
+                if self._recent_buys.get(key, (0, None))[1] is fut:
+                    del self._recent_buys[key]
+        fut.set_result(res)
+        return res
+
+    async def _purchase(self, telegram_id: int, sku: str, quantity: int) -> PurchaseResult:
+        order_id = uuid.uuid4().hex[:10].upper()
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow(
+                """SELECT result, product_name, code_values, price, balance, order_ref, version
+                   FROM purchase_codes($1,$2,$3,$4,$5)""",
+                telegram_id, sku, quantity, order_id, float(self.double_tap_seconds)
+            )
+        self._remember_balance(telegram_id, row["version"], row["balance"])
+        duplicate = row["result"] == "duplicate"
+        return PurchaseResult(
+            status="ok" if duplicate else row["result"],
+            sku=sku,
+            name=row["product_name"],
+            codes=list(row["code_values"] or []),
+            order_id=row["order_ref"] if duplicate or row["result"] == "ok" else None,
+            quantity=quantity,
+            price_cents=int(row["price"] or 0),
+            balance_cents=int(row["balance"] or 0),
+            duplicate=duplicate,
         )
 
-    async def my_orders_text(self, telegram_id: int) -> str:
+    # Codes of an order, whether still in codes or already archived; with telegram_id, only if they bought it.
+    async def order_codes(self, order_id: str, telegram_id: Optional[int] = None) -> List[str]:
         async with self.pool.acquire() as conn:
             rows = await conn.fetch("""
-                SELECT order_id, sku, price_cents, delivered_at
+                SELECT code FROM all_codes
+                WHERE order_id=$1 AND ($2::BIGINT IS NULL OR buyer_telegram_id=$2)
+                ORDER BY id
+            """, order_id, telegram_id)
+            return [r["code"] for r in rows]
+
+    # One page of a user's orders, newest first, plus whether more exist past it. Keyset on (delivered_at,
+    # order_id) instead of OFFSET, so any page is one range scan of idx_orders_user_page. `cursor` is the last
+    # order shown when going to older ones, or the first one shown with newer=True.
+    async def orders_page(self, telegram_id: int, cursor: Optional[Tuple[datetime, str]] = None, newer: bool = False,
+                          limit: int = ORDERS_PAGE) -> Tuple[List[asyncpg.Record], bool]:
+        async with self.pool.acquire() as conn:
+            if cursor is None:
+                rows = await conn.fetch("""
+                    SELECT order_id, sku, price_cents, delivered_at FROM orders
+                    WHERE telegram_id=$1 AND delivered_at IS NOT NULL
+                    ORDER BY delivered_at DESC, order_id DESC
+                    LIMIT $2
+                """, telegram_id, limit + 1)
+            elif newer:
+                rows = await conn.fetch("""
+                    SELECT order_id, sku, price_cents, delivered_at FROM orders
+                    WHERE telegram_id=$1 AND (delivered_at, order_id) > ($2, $3)
+                    ORDER BY delivered_at ASC, order_id ASC
+                    LIMIT $4
+                """, telegram_id, cursor[0], cursor[1], limit + 1)
+            else:
+                rows = await conn.fetch("""
+                    SELECT order_id, sku, price_cents, delivered_at FROM orders
+                    WHERE telegram_id=$1 AND (delivered_at, order_id) < ($2, $3)
+                    ORDER BY delivered_at DESC, order_id DESC
+                    LIMIT $4
+                """, telegram_id, cursor[0], cursor[1], limit + 1)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if newer:
+            rows.reverse()
+        return rows, more
+
+    # (day, sku, orders, codes, cents) for orders delivered in the last `days` calendar days (today included)
+    # in TIMEZONE; a range scan on idx_orders_delivered.
+    async def sales_report(self, days: int) -> List[Tuple[date, str, int, int, int]]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT (delivered_at AT TIME ZONE $1)::date AS day, sku,
+                       COUNT(*)::INTEGER AS orders, SUM(quantity)::INTEGER AS units, SUM(price_cents)::BIGINT AS cents
                 FROM orders
-                WHERE telegram_id=$1
-                ORDER BY delivered_at DESC
-                LIMIT 10
-            """, telegram_id)
-
-        if not rows:
-            return "Aún no tienes compras registradas."
-
-        lines = ["📦 Tus últimas compras (máx. 10):"]
-        for r in rows:
-            lines.append(f"- {r['delivered_at']} | {r['sku']} | {cents_to_money(int(r['price_cents']))} | Orden {r['order_id']}")
-        return "\n".join(lines)
-
-
-# admin_id -> {"sku": str, "codes": [str]}
-PENDING_ADD = {}
-
+                WHERE delivered_at >= (date_trunc('day', now() AT TIME ZONE $1) - make_interval(days => $2 - 1)) AT TIME ZONE $1
+                  AND status = 'paid_delivered'
+                GROUP BY 1, 2
+                ORDER BY 1, 2
+            """, TIMEZONE.key, days)
+        return [(r["day"], r["sku"], int(r["orders"]), int(r["units"]), int(r["cents"])) for r in rows]
+
+    async def create_broadcast(self, admin_id: int, text: str) -> int:
+        async with self.pool.acquire() as conn:
+            return int(await conn.fetchval(
+                "INSERT INTO broadcasts(admin_id, text) VALUES($1,$2) RETURNING id",
+                admin_id, text
+            ))
 
-async def main():
-    if not BOT_TOKEN:
-        raise RuntimeError("Falta BOT_TOKEN en variables de entorno.")
-    if not DATABASE_URL:
-        raise RuntimeError("Falta DATABASE_URL en variables de entorno.")
-    if not ADMIN_IDS:
-        print("⚠️ ADMIN_IDS vacío. /admin no funcionará hasta que agregues ADMIN_IDS en Railway Variables.")
+    async def running_broadcasts(self) -> List[int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+            return [int(r["id"]) for r in rows]
 
-    print("✅ Iniciando bot…")
-    print(f"✅ Admin IDs cargados: {sorted(list(ADMIN_IDS)) if ADMIN_IDS else 'NINGUNO'}")
+    # Takes (or renews) the lease; None if the broadcast is finished or another live process owns it.
+    async def claim_broadcast(self, broadcast_id: int, owner: str) -> Optional[asyncpg.Record]:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("""
+                UPDATE broadcasts SET owner=$2, lease_until = now() + make_interval(secs => $3)
+                WHERE id=$1 AND status='running' AND (owner=$2 OR lease_until IS NULL OR lease_until < now())
+                RETURNING admin_id, text, last_telegram_id, sent, failed, blocked
+            """, broadcast_id, owner, BROADCAST_LEASE_SECONDS)
+
+    # Keyset page over the primary key: each call is a short index range scan, whatever the table size.
+    async def broadcast_recipients(self, after_telegram_id: int, limit: int) -> List[int]:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch(
+                "SELECT telegram_id FROM users WHERE telegram_id > $1 AND blocked_at IS NULL ORDER BY telegram_id LIMIT $2",
+                after_telegram_id, limit
+            )
+            return [int(r["telegram_id"]) for r in rows]
 
-    pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5, command_timeout=30)
-    db = DB(pool)
-    await db.init()
+    # Checkpoints one sent page and marks its blocked recipients in the same statement, renewing the lease.
+    # Returns False if the lease was lost meanwhile, in which case nothing is written.
+    async def save_broadcast_progress(self, broadcast_id: int, owner: str, last_telegram_id: int,
+                                      sent: int, failed: int, blocked: List[int]) -> bool:
+        async with self.pool.acquire() as conn:
+            ok = await conn.fetchval("""
+                WITH b AS (
+                    UPDATE broadcasts
+                    SET last_telegram_id=$3, sent=sent+$4, failed=failed+$5, blocked=blocked+cardinality($6::BIGINT[]),
+                        lease_until = now() + make_interval(secs => $7)
+                    WHERE id=$1 AND owner=$2 AND status='running'
+                    RETURNING id
+                ), u AS (
+                    UPDATE users SET blocked_at=now()
+                    WHERE telegram_id = ANY($6::BIGINT[]) AND EXISTS (SELECT 1 FROM b)
+                    RETURNING telegram_id
+                )
+                SELECT EXISTS (SELECT 1 FROM b), (SELECT count(pg_notify($8, telegram_id::TEXT)) FROM u)
+            """, broadcast_id, owner, last_telegram_id, sent, failed, blocked, BROADCAST_LEASE_SECONDS, BLOCKED_CHANNEL)
+        # Every process forgets them (here too, without waiting for the notify), so whichever one sees their
+        # next message goes through upsert_user's first-sighting write, which clears blocked_at.
+        for tid in blocked:
+            self._profiles.pop(tid, None)
+        return bool(ok)
+
+    async def finish_broadcast(self, broadcast_id: int, owner: str, done: bool) -> Optional[asyncpg.Record]:
+        # done=False just hands the lease back (shutdown), so the next process resumes without waiting it out.
+        async with self.pool.acquire() as conn:
+            return await conn.fetchrow("""
+                UPDATE broadcasts
+                SET status = CASE WHEN $3 THEN 'done' ELSE status END,
+                    finished_at = CASE WHEN $3 THEN now() ELSE finished_at END,
+                    owner=NULL, lease_until=NULL
+                WHERE id=$1 AND owner=$2
+                RETURNING sent, failed, blocked
+            """, broadcast_id, owner, done)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def wait_time(self) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def take(self):
+        self._refill(time.monotonic())
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    def idle(self) -> bool:
+        return self.wait_time() == 0 and self.tokens >= self.capacity
+
+
+class OutboxJob:
+    __slots__ = ("method", "chat_id", "priority", "seq", "future", "attempts", "edit_key", "stale")
+
+    def __init__(self, method: TelegramMethod, chat_id: int, priority: int, seq: int, edit_key=None,
+                 future: Optional[asyncio.Future] = None):
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.future: asyncio.Future = future or asyncio.get_running_loop().create_future()
+        self.attempts = 0
+        self.edit_key = edit_key
+        self.stale = False  # superseded by a more urgent copy; skipped when it reaches the front
+
+    def __lt__(self, other: "OutboxJob") -> bool:
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Outbox:
+    # Every outgoing message goes through here instead of being awaited inside the handler: a global token
+    # bucket keeps the bot under Telegram's ~30 msg/s, per-chat buckets under ~1 msg/s (20/min in groups),
+    # lower priority numbers go first, 429s park only the affected chat, and queued edits of the same
+    # message collapse into the latest one. Callers get a future and only await it when they need the result.
+    def __init__(self, bot: Bot, rate: float = OUTBOX_RATE, max_in_flight: int = 20):
+        self.bot = bot
+        self.global_bucket = TokenBucket(rate, max(1.0, rate))
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.queue: "asyncio.PriorityQueue[OutboxJob]" = asyncio.PriorityQueue()
+        self.pending_edits: Dict[Tuple[int, int], OutboxJob] = {}
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.in_flight: Set[asyncio.Task] = set()
+        self.seq = 0
+        self.waiting = 0  # jobs parked in call_later until their chat has a token again
+        self.runner: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.runner = asyncio.create_task(self._run())
+
+    async def close(self, timeout: float = 10.0):
+        deadline = time.monotonic() + timeout
+        while (not self.queue.empty() or self.waiting or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self.runner:
+            self.runner.cancel()
+
+    def submit(self, method: TelegramMethod, priority: int = PRIO_REPLY) -> asyncio.Future:
+        chat_id = int(method.chat_id)
+        edit_key = None
+        if isinstance(method, EditMessageText) and method.message_id:
+            edit_key = (chat_id, method.message_id)
+            queued = self.pending_edits.get(edit_key)
+            if queued is not None:
+                # Not sent yet: send the newest text instead, once, at the most urgent of both priorities.
+                queued.method = method
+                if priority >= queued.priority:
+                    return queued.future
+                # Its priority is part of its heap position, so it can't be lowered in place: leave the old
+                # entry behind as stale and queue a copy that resolves the same future.
+                queued.stale = True
+                self.seq += 1
+                job = OutboxJob(method, chat_id, priority, self.seq, edit_key, queued.future)
+                job.attempts = queued.attempts
+                self.pending_edits[edit_key] = job
+                self.queue.put_nowait(job)
+                return job.future
+        self.seq += 1
+        job = OutboxJob(method, chat_id, priority, self.seq, edit_key)
+        job.future.add_done_callback(self._log_failure)
+        if edit_key:
+            self.pending_edits[edit_key] = job
+        self.queue.put_nowait(job)
+        return job.future
+
+    def answer(self, m: Message, text: str, priority: int = PRIO_REPLY, reply: bool = False, **kwargs) -> asyncio.Future:
+        if reply:
+            kwargs["reply_parameters"] = ReplyParameters(message_id=m.message_id)
+        return self.submit(SendMessage(chat_id=m.chat.id, text=text, **kwargs), priority)
+
+    def edit(self, m: Message, text: str, priority: int = PRIO_REPLY, **kwargs) -> asyncio.Future:
+        return self.submit(EditMessageText(chat_id=m.chat.id, message_id=m.message_id, text=text, **kwargs), priority)
+
+    def document(self, m: Message, document: BufferedInputFile, priority: int = PRIO_REPLY, **kwargs) -> asyncio.Future:
+        return self.submit(SendDocument(chat_id=m.chat.id, document=document, **kwargs), priority)
+
+    @staticmethod
+    def _log_failure(fut: asyncio.Future):
+        # A user who blocked the bot is routine, not an error worth a log line.
+        if not fut.cancelled() and fut.exception() is not None and not isinstance(fut.exception(), TelegramForbiddenError):
+            print(f"⚠️ Envío a Telegram falló: {fut.exception()}")
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                self.chat_buckets = {k: b for k, b in self.chat_buckets.items() if not b.idle()}
+            rate, burst = (CHAT_RATE, CHAT_BURST) if chat_id > 0 else (GROUP_RATE, GROUP_BURST)
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def _park(self, job: OutboxJob, delay: float):
+        # Re-queued with its original (priority, seq), so it keeps its place ahead of newer jobs.
+        def requeue():
+            self.waiting -= 1
+            self.queue.put_nowait(job)
+        self.waiting += 1
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _run(self):
+        while True:
+            job = await self.queue.get()
+            if job.stale:
+                continue
+            if job.future.cancelled():
+                # The caller gave up on it (e.g. a broadcast stopping): drop it without spending a token.
+                if job.edit_key and self.pending_edits.get(job.edit_key) is job:
+                    del self.pending_edits[job.edit_key]
+                continue
+            chat = self._chat_bucket(job.chat_id)
+            wait = chat.wait_time()
+            if wait > 0:
+                self._park(job, wait)
+                continue
+            while (wait := self.global_bucket.wait_time()) > 0:
+                await asyncio.sleep(wait)
+            self.global_bucket.take()
+            chat.take()
+            if job.edit_key:
+                self.pending_edits.pop(job.edit_key, None)
+            await self.slots.acquire()
+            task = asyncio.create_task(self._send(job))
+            self.in_flight.add(task)
+            task.add_done_callback(self.in_flight.discard)
+
+    async def _send(self, job: OutboxJob):
+        try:
+            job.attempts += 1
+            self._settle(job, result=await self.bot(job.method))
+        except TelegramRetryAfter as e:
+            self._chat_bucket(job.chat_id).block(e.retry_after)
+            self._retry(job, e, e.retry_after)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._retry(job, e, 2.0 ** job.attempts)
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                self._settle(job, result=True)
+            else:
+                self._settle(job, error=e)
+        except Exception as e:
+            self._settle(job, error=e)
+        finally:
+            self.slots.release()
+
+    @staticmethod
+    def _settle(job: OutboxJob, result=None, error: Optional[Exception] = None):
+        if job.future.done():  # cancelled by the caller while in flight
+            return
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(result)
 
-    bot = Bot(BOT_TOKEN)
+    def _retry(self, job: OutboxJob, error: Exception, delay: float):
+        if job.attempts >= OUTBOX_MAX_ATTEMPTS or job.future.cancelled():
+            self._settle(job, error=error)
+            return
+        if job.edit_key and job.edit_key not in self.pending_edits:
+            self.pending_edits[job.edit_key] = job
+        self._park(job, delay)
+
+
+class Broadcaster:
+    # Sends /broadcast announcements through the outbox's bulk lane, one page of recipients at a time, so
+    # memory stays flat with any number of users and purchases keep priority over the announcement.
+    # Each page is checkpointed under a lease: after a crash at most one page is sent twice, and whichever
+    # process notices the expired lease first carries on from last_telegram_id.
+    def __init__(self, db: DB, outbox: Outbox):
+        self.db = db
+        self.outbox = outbox
+        self.owner = uuid.uuid4().hex
+        # Small enough that a page goes out well within the lease at this process's share of the rate.
+        self.batch = max(10, min(BROADCAST_BATCH, int(outbox.global_bucket.rate * BROADCAST_LEASE_SECONDS / 4)))
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self.watcher: Optional[asyncio.Task] = None
+        self.stopping = False
+
+    def start(self):
+        self.watcher = asyncio.create_task(self._watch())
+
+    async def close(self, timeout: float = 10.0):
+        # Lets the page in progress finish when it can; otherwise it is cancelled and resent on resume.
+        self.stopping = True
+        if self.watcher:
+            self.watcher.cancel()
+        tasks = list(self.tasks.values())
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+    async def begin(self, admin_id: int, text: str) -> int:
+        broadcast_id = await self.db.create_broadcast(admin_id, text)
+        self._spawn(broadcast_id)
+        return broadcast_id
+
+    def _spawn(self, broadcast_id: int):
+        if self.stopping or broadcast_id in self.tasks:
+            return
+        task = asyncio.create_task(self._run(broadcast_id))
+        self.tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+
+    async def _watch(self):
+        # Picks up broadcasts left running by a crash or a shutdown, here or in another process.
+        while True:
+            try:
+                for broadcast_id in await self.db.running_broadcasts():
+                    self._spawn(broadcast_id)
+            except Exception as e:
+                print(f"⚠️ Error buscando difusiones pendientes: {e}")
+            await asyncio.sleep(BROADCAST_LEASE_SECONDS / 2)
+
+    async def _status(self, admin_id: int, message_id: Optional[int], text: str) -> Optional[int]:
+        try:
+            if message_id is None:
+                msg = await self.outbox.submit(SendMessage(chat_id=admin_id, text=text), PRIO_REPLY)
+                return msg.message_id
+            self.outbox.submit(EditMessageText(chat_id=admin_id, message_id=message_id, text=text), PRIO_REPLY)
+        except Exception as e:
+            print(f"⚠️ No pude avisar al admin {admin_id}: {e}")
+        return message_id
+
+    async def _run(self, broadcast_id: int):
+        row = await self.db.claim_broadcast(broadcast_id, self.owner)
+        if row is None:
+            return
+        admin_id, text, cursor = int(row["admin_id"]), row["text"], int(row["last_telegram_id"])
+        sent, failed, blocked = int(row["sent"]), int(row["failed"]), int(row["blocked"])
+        verb = "reanudando" if cursor else "enviando"
+        status = await self._status(admin_id, None, f"📣 Difusión #{broadcast_id}: {verb}…")
+        t0 = last_edit = time.perf_counter()
+        attempted = 0
+        done = False
+
+        def progress() -> str:
+            rate = attempted / max(time.perf_counter() - t0, 1e-9)
+            return f"{sent} enviados, {blocked} bloqueados, {failed} fallidos ({rate:.1f}/s)"
+
+        try:
+            while not self.stopping:
+                ids = await self.db.broadcast_recipients(cursor, self.batch)
+                if not ids:
+                    done = True
+                    break
+                futures = [self.outbox.submit(SendMessage(chat_id=tid, text=text), PRIO_BULK) for tid in ids]
+                try:
+                    await asyncio.wait(futures)
+                except asyncio.CancelledError:
+                    for fut in futures:
+                        fut.cancel()
+                    raise
+                errors = [fut.exception() for fut in futures]
+                page_blocked = [tid for tid, e in zip(ids, errors) if isinstance(e, TelegramForbiddenError)]
+                page_failed = sum(1 for e in errors if e is not None) - len(page_blocked)
+                page_sent = len(ids) - page_failed - len(page_blocked)
+                if not await self.db.save_broadcast_progress(
+                    broadcast_id, self.owner, ids[-1], page_sent, page_failed, page_blocked
+                ):
+                    print(f"⚠️ Difusión #{broadcast_id}: otro proceso tomó el relevo.")
+                    return
+                cursor = ids[-1]
+                attempted += len(ids)
+                sent, failed, blocked = sent + page_sent, failed + page_failed, blocked + len(page_blocked)
+                if time.perf_counter() - last_edit >= BROADCAST_PROGRESS_SECONDS:
+                    last_edit = time.perf_counter()
+                    await self._status(admin_id, status, f"📣 Difusión #{broadcast_id}: {progress()}…")
+        finally:
+            try:
+                await self.db.finish_broadcast(broadcast_id, self.owner, done)
+            except Exception as e:
+                print(f"⚠️ Difusión #{broadcast_id}: no pude liberar el lease: {e}")
+        if done:
+            print(f"📣 Difusión #{broadcast_id} terminada: {progress()}")
+            await self._status(admin_id, status, f"✅ Difusión #{broadcast_id} terminada: {progress()}")
+
+
+def build_dispatcher(db: DB, outbox: Outbox, broadcaster: Broadcaster) -> Dispatcher:
     dp = Dispatcher()
 
     # ---- USERS ----
     @dp.message(CommandStart())
     async def start(m: Message):
         await db.upsert_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
-        await m.answer(
+        outbox.answer(
+            m,
             "👋 ¡Hola! Bienvenido.\n\n"
             "Este bot entrega códigos automáticamente.\n"
-            "Usa el menú para comprar o consultar tu saldo.",
+            "Usa el menú para comprar o consultar tu saldo.\n"
+            "Para comprar varios a la vez: /comprar SKU 10\n"
+            "Tus movimientos de saldo: /movs",
             reply_markup=main_menu_kb()
         )
 
     @dp.message(Command("id"))
     async def myid(m: Message):
         await db.upsert_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
-        await m.answer(f"Tu Telegram ID es: `{m.from_user.id}`", parse_mode="Markdown")
+        outbox.answer(m, f"Tu Telegram ID es: `{m.from_user.id}`", parse_mode="Markdown")
+
+    # /movs: your own balance moves; an admin can pass @usuario to see someone else's.
+    @dp.message(Command("movs"))
+    async def movs(m: Message):
+        await db.upsert_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
+        parts = m.text.split()
+        if len(parts) == 2 and is_admin(m.from_user.id):
+            uid = await db.user_id_by_username(parts[1])
+            if not uid:
+                outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
+                return
+            outbox.answer(m, statement_text(await db.statement(uid), f"💳 Movimientos de {parts[1]}"))
+            return
+        outbox.answer(m, statement_text(await db.statement(m.from_user.id), "💳 Tus últimos movimientos"))
 
     @dp.callback_query(F.data.startswith("menu:"))
     async def menu(call: CallbackQuery):
@@ -347,16 +2051,17 @@ async def main():
         if action == "buy":
             rows = await db.list_active_products()
             if not rows:
-                await call.message.edit_text("⚠️ Aún no hay productos cargados.", reply_markup=main_menu_kb())
+                outbox.edit(call.message, "⚠️ Aún no hay productos cargados.", reply_markup=main_menu_kb())
                 return
-            await call.message.edit_text("🛒 Elige un producto:", reply_markup=products_kb(rows))
+            outbox.edit(call.message, "🛒 Elige un producto:", reply_markup=products_kb(rows))
 
         elif action == "balance":
             bal = await db.get_balance(call.from_user.id)
-            await call.message.edit_text(f"💰 Tu saldo actual: {cents_to_money(bal)}", reply_markup=main_menu_kb())
+            outbox.edit(call.message, f"💰 Tu saldo actual: {cents_to_money(bal)}", reply_markup=main_menu_kb())
 
         elif action == "topup":
-            await call.message.edit_text(
+            outbox.edit(
+                call.message,
                 "➕ *Recargar saldo*\n\n"
                 "Para recargar, contacta a soporte con:\n"
                 "- Tu usuario (@usuario)\n"
@@ -367,11 +2072,13 @@ async def main():
             )
 
         elif action == "orders":
-            txt = await db.my_orders_text(call.from_user.id)
-            await call.message.edit_text(txt, reply_markup=main_menu_kb())
+            rows, more = await db.orders_page(call.from_user.id)
+            kb = orders_kb(rows, has_newer=False, has_older=more) if rows else main_menu_kb()
+            outbox.edit(call.message, orders_text(rows), reply_markup=kb)
 
         elif action == "support":
-            await call.message.edit_text(
+            outbox.edit(
+                call.message,
                 "🆘 Soporte\n\n"
                 "Escríbenos por este chat y te atendemos.\n"
                 "Si necesitas recarga, envía @usuario y monto MXN.",
@@ -379,34 +2086,120 @@ async def main():
             )
 
         elif action == "back":
-            await call.message.edit_text("Menú principal:", reply_markup=main_menu_kb())
+            outbox.edit(call.message, "Menú principal:", reply_markup=main_menu_kb())
+
+    def send_purchase(target: Message, res: PurchaseResult, edit: bool):
+        send = outbox.edit if edit else outbox.answer
+        if res.status != "ok":
+            send(target, purchase_text(res), reply_markup=main_menu_kb())
+            return
+        inline = sum(len(c) + 3 for c in res.codes) <= INLINE_CODES_MAX_CHARS
+        txt = purchase_text(res, codes_inline=inline)
+        send(target, txt, priority=PRIO_DELIVERY, parse_mode="Markdown", reply_markup=buy_more_kb(res.sku))
+        if not inline:
+            data = ("\n".join(res.codes) + "\n").encode()
+            outbox.document(
+                target,
+                BufferedInputFile(data, filename=f"orden_{res.order_id}.txt"),
+                priority=PRIO_DELIVERY,
+                caption=f"Orden {res.order_id} — {res.quantity} códigos"
+            )
+
+    # ord:next:{cursor} / ord:prev:{cursor}: older / newer page of "📦 Mis compras".
+    @dp.callback_query(F.data.startswith("ord:"))
+    async def orders_nav(call: CallbackQuery):
+        await call.answer()
+        _, direction, cursor = call.data.split(":", 2)
+        newer = direction == "prev"
+        rows, more = await db.orders_page(call.from_user.id, parse_order_cursor(cursor), newer=newer)
+        has_newer, has_older = (more, True) if newer else (True, more)
+        if not rows:
+            # Nothing on that side any more: start over from the latest orders.
+            rows, more = await db.orders_page(call.from_user.id)
+            has_newer, has_older = False, more
+        kb = orders_kb(rows, has_newer, has_older) if rows else main_menu_kb()
+        outbox.edit(call.message, orders_text(rows), reply_markup=kb)
+
+    @dp.callback_query(F.data.startswith("order:"))
+    async def order_again(call: CallbackQuery):
+        await call.answer()
+        order_id = call.data.split(":", 1)[1]
+        codes = await db.order_codes(order_id, telegram_id=call.from_user.id)
+        if not codes:
+            outbox.answer(call.message, f"No encontré la orden {order_id}.")
+            return
+        send_order_codes(call.message, order_id, codes)
+
+    def send_order_codes(target: Message, order_id: str, codes: List[str]):
+        if sum(len(c) + 3 for c in codes) <= INLINE_CODES_MAX_CHARS:
+            outbox.answer(target, f"Orden `{order_id}` ({len(codes)} códigos):\n" + "\n".join(f"`{c}`" for c in codes),
+                          parse_mode="Markdown")
+            return
+        data = ("\n".join(codes) + "\n").encode()
+        outbox.document(target, BufferedInputFile(data, filename=f"orden_{order_id}.txt"),
+                        caption=f"Orden {order_id} — {len(codes)} códigos")
 
     @dp.callback_query(F.data.startswith("buy:"))
     async def buy(call: CallbackQuery):
+        # buy:{sku} or buy:{sku}:{n}
+        rest = call.data.split(":", 1)[1]
+        sku, _, n = rest.rpartition(":")
+        if not (sku and n.isdigit()):
+            sku, n = rest, "1"
+        qty = int(n)
+        if not 1 <= qty <= MAX_BUY_QTY:
+            await call.answer()
+            return
+        try:
+            res = await db.deliver_purchase(call.from_user.id, sku, qty, request_id=call.id)
+        except Exception:
+            await call.answer("⚠️ No se pudo completar la compra. Intenta de nuevo.", show_alert=True)
+            raise
+        if res.duplicate:
+            # The first tap already showed this result; only a completed order deserves the notice.
+            await call.answer("Esa compra ya se procesó" if res.status == "ok" else None, show_alert=False)
+            return
         await call.answer()
-        sku = call.data.split(":", 1)[1]
-        ok, msg = await db.deliver_purchase(call.from_user.id, sku)
-        if ok:
-            await call.message.edit_text(msg, parse_mode="Markdown", reply_markup=main_menu_kb())
-        else:
-            await call.message.edit_text(msg, reply_markup=main_menu_kb())
+        send_purchase(call.message, res, edit=True)
+
+    @dp.message(Command("comprar"))
+    async def comprar(m: Message):
+        await db.upsert_user(m.from_user.id, m.from_user.username, m.from_user.first_name)
+        parts = m.text.split()
+        if len(parts) not in (2, 3) or (len(parts) == 3 and not parts[2].isdigit()):
+            outbox.answer(m, "Uso: /comprar SKU 10")
+            return
+        sku = parts[1].strip().upper()
+        qty = int(parts[2]) if len(parts) == 3 else 1
+        if not 1 <= qty <= MAX_BUY_QTY:
+            outbox.answer(m, f"Cantidad inválida. Máximo {MAX_BUY_QTY} por compra.")
+            return
+        res = await db.deliver_purchase(m.from_user.id, sku, qty)
+        send_purchase(m, res, edit=False)
 
     # ---- ADMIN ----
     @dp.message(Command("admin"))
     async def admin_help(m: Message):
         if not is_admin(m.from_user.id):
             return
-        await m.answer(
+        outbox.answer(
+            m,
             "🛠️ *Comandos admin*\n\n"
             "`/sumar @usuario 200`\n"
             "`/restar @usuario 50`\n"
-            "`/saldo @usuario`\n\n"
-            "`/addcodes SKU` (luego pega códigos, 1 por línea)\n"
-            "`/done` (termina carga)\n\n"
+            "`/saldo @usuario`\n"
+            "`/movs @usuario` (movimientos de saldo)\n\n"
+            "`/addcodes SKU` (luego pega códigos, 1 por línea, o envía un .txt/.csv)\n"
+            "`/done` (guarda la carga) | `/cancel` (la descarta)\n"
+            "`/recargas` en el pie de un .csv `@usuario,monto,ref` (recargas en lote)\n\n"
             "`/stock` o `/stock SKU`\n"
+            "`/recontar` (verifica y repara el stock)\n"
             "`/precio SKU 129`\n"
             "`/nombre SKU Nombre Bonito`\n"
-            "`/activar SKU` | `/desactivar SKU`\n",
+            "`/activar SKU` | `/desactivar SKU`\n"
+            "`/ventas` o `/ventas 30` (días)\n"
+            "`/orden ID` (códigos entregados en una orden)\n\n"
+            "`/broadcast Texto del anuncio` (a todos los usuarios)\n",
             parse_mode="Markdown"
         )
 
@@ -416,14 +2209,14 @@ async def main():
             return
         parts = m.text.split()
         if len(parts) != 2:
-            await m.answer("Uso: /saldo @usuario")
+            outbox.answer(m, "Uso: /saldo @usuario")
             return
         uid = await db.user_id_by_username(parts[1])
         if not uid:
-            await m.answer("No encontré ese usuario. Pídele que use /start primero.")
+            outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
             return
         bal = await db.get_balance(uid)
-        await m.answer(f"Saldo de {parts[1]}: {cents_to_money(bal)}")
+        outbox.answer(m, f"Saldo de {parts[1]}: {cents_to_money(bal)}")
 
     @dp.message(Command("sumar"))
     async def admin_sumar(m: Message):
@@ -431,20 +2224,22 @@ async def main():
             return
         parts = m.text.split()
         if len(parts) != 3:
-            await m.answer("Uso: /sumar @usuario 200")
+            outbox.answer(m, "Uso: /sumar @usuario 200")
             return
         uid = await db.user_id_by_username(parts[1])
         if not uid:
-            await m.answer("No encontré ese usuario. Pídele que use /start primero.")
+            outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
             return
         cents = money_to_cents(parts[2])
         if cents is None or cents <= 0:
-            await m.answer("Monto inválido. Ej: 200 o 200.50")
+            outbox.answer(m, "Monto inválido. Ej: 200 o 200.50")
+            return
+        res = await db.adjust_balance(uid, cents, "topup", ref=f"admin:{m.from_user.id}")
+        if res is None:
+            outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
             return
-        before = await db.get_balance(uid)
-        after = before + cents
-        await db.set_balance_with_move(uid, after, "topup", cents, ref=f"admin:{m.from_user.id}")
-        await m.answer(f"✅ Recarga aplicada a {parts[1]}. Nuevo saldo: {cents_to_money(after)}")
+        _, after = res
+        outbox.answer(m, f"✅ Recarga aplicada a {parts[1]}. Nuevo saldo: {cents_to_money(after)}")
 
     @dp.message(Command("restar"))
     async def admin_restar(m: Message):
@@ -452,34 +2247,217 @@ async def main():
             return
         parts = m.text.split()
         if len(parts) != 3:
-            await m.answer("Uso: /restar @usuario 50")
+            outbox.answer(m, "Uso: /restar @usuario 50")
             return
         uid = await db.user_id_by_username(parts[1])
         if not uid:
-            await m.answer("No encontré ese usuario. Pídele que use /start primero.")
+            outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
             return
         cents = money_to_cents(parts[2])
         if cents is None or cents <= 0:
-            await m.answer("Monto inválido. Ej: 50 o 50.00")
+            outbox.answer(m, "Monto inválido. Ej: 50 o 50.00")
+            return
+        res = await db.adjust_balance(uid, -cents, "admin_adjust", ref=f"admin:{m.from_user.id}")
+        if res is None:
+            outbox.answer(m, "No encontré ese usuario. Pídele que use /start primero.")
+            return
+        _, after = res
+        outbox.answer(m, f"✅ Ajuste aplicado a {parts[1]}. Nuevo saldo: {cents_to_money(after)}")
+
+    @dp.message(Command("precio"))
+    async def admin_precio(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split()
+        cents = money_to_cents(parts[2]) if len(parts) == 3 else None
+        if cents is None:
+            outbox.answer(m, "Uso: /precio SKU 129")
+            return
+        sku = parts[1].upper()
+        if not await db.set_price(sku, cents):
+            outbox.answer(m, f"No existe el producto {sku}.")
+            return
+        outbox.answer(m, f"✅ Precio de {sku}: {cents_to_money(cents)}")
+
+    @dp.message(Command("nombre"))
+    async def admin_nombre(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split(maxsplit=2)
+        if len(parts) != 3:
+            outbox.answer(m, "Uso: /nombre SKU Nombre Bonito")
+            return
+        sku = parts[1].upper()
+        if not await db.set_name(sku, parts[2].strip()):
+            outbox.answer(m, f"No existe el producto {sku}.")
+            return
+        outbox.answer(m, f"✅ Nombre de {sku}: {parts[2].strip()}")
+
+    @dp.message(Command("activar", "desactivar"))
+    async def admin_activar(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split()
+        active = parts[0].lstrip("/").split("@")[0].lower() == "activar"
+        if len(parts) != 2:
+            outbox.answer(m, f"Uso: {parts[0]} SKU")
+            return
+        sku = parts[1].upper()
+        if not await db.set_active(sku, active):
+            outbox.answer(m, f"No existe el producto {sku}.")
+            return
+        outbox.answer(m, f"✅ {sku} {'activado' if active else 'desactivado'}.")
+
+    @dp.message(Command("stock"))
+    async def admin_stock(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split()
+        if len(parts) == 2:
+            sku = parts[1].strip().upper()
+            outbox.answer(m, f"📦 Stock de {sku}: {await db.stock_for_sku(sku)}")
+            return
+        rows = await db.stock_all()
+        if not rows:
+            outbox.answer(m, "Aún no hay productos cargados.")
             return
-        before = await db.get_balance(uid)
-        after = before - cents
-        await db.set_balance_with_move(uid, after, "admin_adjust", -cents, ref=f"admin:{m.from_user.id}")
-        await m.answer(f"✅ Ajuste aplicado a {parts[1]}. Nuevo saldo: {cents_to_money(after)}")
+        lines = ["📦 Stock disponible:"]
+        for sku, name, active, available in rows:
+            lines.append(f"- {sku} ({name}): {available}" + ("" if active else " [inactivo]"))
+        outbox.answer(m, "\n".join(lines))
+
+    @dp.message(Command("recontar"))
+    async def admin_recontar(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        drift = await db.recount_stock()
+        if not drift:
+            outbox.answer(m, "✅ Stock verificado: todos los contadores coinciden.")
+            return
+        lines = [f"🔧 Corregidos {len(drift)} contadores:"]
+        for sku, counter, real in drift:
+            lines.append(f"- {sku}: {counter} → {real}")
+        outbox.answer(m, "\n".join(lines))
+
+    @dp.message(Command("ventas"))
+    async def admin_ventas(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split()
+        days = 7 if len(parts) == 1 else int(parts[1]) if len(parts) == 2 and parts[1].isdigit() else 0
+        if not 1 <= days <= 60:  # one line per day must fit in a message
+            outbox.answer(m, "Uso: /ventas o /ventas 30 (días, máx. 60)")
+            return
+        rows = await db.sales_report(days)
+        if not rows:
+            outbox.answer(m, f"Sin ventas en los últimos {days} días.")
+            return
+        by_day: Dict[date, List[int]] = {}
+        by_sku: Dict[str, List[int]] = {}
+        for day, sku, orders, units, cents in rows:
+            for bucket in (by_day.setdefault(day, [0, 0, 0]), by_sku.setdefault(sku, [0, 0, 0])):
+                bucket[0] += orders
+                bucket[1] += units
+                bucket[2] += cents
+        lines = [f"📈 Ventas de los últimos {days} días ({TIMEZONE.key}):"]
+        for day, (orders, units, cents) in by_day.items():
+            lines.append(f"- {day:%Y-%m-%d}: {orders} órdenes, {units} códigos, {cents_to_money(cents)}")
+        lines.append("\nPor producto:")
+        for sku, (orders, units, cents) in sorted(by_sku.items(), key=lambda kv: -kv[1][2]):
+            lines.append(f"- {sku}: {units} códigos, {cents_to_money(cents)}")
+        total = [sum(v[i] for v in by_sku.values()) for i in range(3)]
+        lines.append(f"\nTotal: {total[0]} órdenes, {total[1]} códigos, {cents_to_money(total[2])}")
+        outbox.answer(m, "\n".join(lines))
+
+    @dp.message(Command("orden"))
+    async def admin_orden(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split()
+        if len(parts) != 2:
+            outbox.answer(m, "Uso: /orden ID")
+            return
+        order_id = parts[1].strip().upper()
+        codes = await db.order_codes(order_id)
+        if not codes:
+            outbox.answer(m, f"No encontré la orden {order_id}.")
+            return
+        send_order_codes(m, order_id, codes)
+
+    @dp.message(Command("broadcast"))
+    async def admin_broadcast(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        parts = m.text.split(maxsplit=1)
+        if len(parts) != 2 or not parts[1].strip():
+            outbox.answer(m, "Uso: /broadcast ¡Ya hay stock de DISNEY_1M!")
+            return
+        broadcast_id = await broadcaster.begin(m.from_user.id, parts[1].strip())
+        outbox.answer(m, f"📣 Difusión #{broadcast_id} en cola. Te aviso del avance aquí.")
+
+    async def ingest_document(m: Message, sku: str):
+        doc = m.document
+        fname = (doc.file_name or "").lower()
+        if not fname.endswith((".txt", ".csv")):
+            outbox.answer(m, "Solo acepto archivos .txt o .csv (un código por línea).")
+            return
+        if doc.file_size and doc.file_size > MAX_DOCUMENT_BYTES:
+            outbox.answer(m, "El archivo pasa de 20 MB (límite de descarga de Telegram). Divídelo en partes.")
+            return
+        is_csv = fname.endswith(".csv")
+        progress = await outbox.answer(m, f"📥 Procesando `{doc.file_name}` para `{sku}`…", parse_mode="Markdown")
+        t0 = time.perf_counter()
+        last_edit = t0
+        inserted = dupes = 0
+        chunk: List[str] = []
+        try:
+            async for line in iter_document_lines(m.bot, doc.file_id):
+                code = csv_first_cell(line) if is_csv else line.strip()
+                if code:
+                    chunk.append(code)
+                if len(chunk) >= INGEST_CHUNK:
+                    res = await db.add_codes(sku, chunk)
+                    inserted += res.inserted
+                    dupes += res.duplicates
+                    chunk = []
+                    if time.perf_counter() - last_edit >= PROGRESS_EDIT_SECONDS:
+                        last_edit = time.perf_counter()
+                        outbox.edit(progress, f"📥 `{sku}`: {inserted} códigos cargados…", parse_mode="Markdown")
+            if chunk:
+                res = await db.add_codes(sku, chunk)
+                inserted += res.inserted
+                dupes += res.duplicates
+        except Exception as e:
+            # Every chunk before the failing one is already committed: say how far it got.
+            print(f"⚠️ Error cargando {doc.file_name} para {sku}: {e}")
+            outbox.edit(progress, f"❌ {sku}: la carga se interrumpió ({e}).\n"
+                                  f"Ya guardados: {inserted} códigos nuevos, {dupes} duplicados. "
+                                  f"Puedes reenviar el archivo: los ya cargados cuentan como duplicados.")
+            return
+        res = IngestResult(inserted=inserted, duplicates=dupes, seconds=time.perf_counter() - t0)
+        outbox.edit(progress, f"✅ `{sku}`: {ingest_text(res)}", parse_mode="Markdown")
 
     @dp.message(Command("addcodes"))
     async def admin_addcodes(m: Message):
         if not is_admin(m.from_user.id):
             return
-        parts = m.text.split(maxsplit=1)
+        # Also matches a document whose caption is "/addcodes SKU".
+        parts = (m.text or m.caption).split(maxsplit=1)
         if len(parts) != 2:
-            await m.answer("Uso: /addcodes DISNEY_1M")
+            outbox.answer(m, "Uso: /addcodes DISNEY_1M")
             return
         sku = parts[1].strip().upper()
-        PENDING_ADD[m.from_user.id] = {"sku": sku, "codes": []}
         await db.ensure_product(sku, name=sku, price_cents=0)
-        await m.answer(
-            f"📥 Listo. Pega los códigos para `{sku}` (uno por línea).\n"
+        if m.document:
+            await ingest_document(m, sku)
+            return
+        dropped = await db.start_upload(m.from_user.id, sku)
+        if dropped:
+            outbox.answer(m, f"🗑️ Descarté {dropped} códigos pendientes de la carga anterior.")
+        outbox.answer(
+            m,
+            f"📥 Listo. Pega los códigos para `{sku}` (uno por línea)\n"
+            f"o envía un archivo .txt / .csv.\n"
             f"Cuando termines escribe `/done`.",
             parse_mode="Markdown"
         )
@@ -488,19 +2466,472 @@ async def main():
     async def admin_done(m: Message):
         if not is_admin(m.from_user.id):
             return
-        payload = PENDING_ADD.pop(m.from_user.id, None)
-        if not text:
+        done = await db.commit_upload(m.from_user.id)
+        if not done:
+            outbox.answer(m, "No tienes una carga abierta. Usa /addcodes SKU primero.")
             return
-        lines = [x.strip() for x in text.splitlines() if x.strip()]
-        payload["codes"].extend(lines)
-        await m.reply(f"📌 Agregados {len(lines)} (pendientes totales: {len(payload['codes'])}). Escribe /done para guardar.")
+        sku, res = done
+        outbox.answer(m, f"✅ `{sku}`: {ingest_text(res)}", parse_mode="Markdown")
 
-    # ---- START POLLING ----
+    @dp.message(Command("cancel"))
+    async def admin_cancel(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        dropped = await db.discard_upload(m.from_user.id)
+        if not dropped:
+            outbox.answer(m, "No tienes una carga abierta.")
+            return
+        sku, staged = dropped
+        outbox.answer(m, f"🗑️ Carga de `{sku}` cancelada ({staged} códigos descartados).", parse_mode="Markdown")
+
+    # /recargas as the caption of a .csv with `@usuario,monto,ref` lines. Every line gets a result in the
+    # file sent back; re-sending the same file only reports its refs as already applied.
+    @dp.message(Command("recargas"))
+    async def admin_recargas(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        doc = m.document
+        if not doc:
+            outbox.answer(m, "Envía un .csv con líneas `@usuario,monto,ref` y escribe /recargas en el pie del archivo.",
+                          parse_mode="Markdown")
+            return
+        if not (doc.file_name or "").lower().endswith(".csv"):
+            outbox.answer(m, "Solo acepto archivos .csv (`@usuario,monto,ref`).", parse_mode="Markdown")
+            return
+        if doc.file_size and doc.file_size > MAX_DOCUMENT_BYTES:
+            outbox.answer(m, "El archivo pasa de 20 MB (límite de descarga de Telegram). Divídelo en partes.")
+            return
+        progress = await outbox.answer(m, f"📥 Procesando recargas de `{doc.file_name}`…", parse_mode="Markdown")
+        t0 = time.perf_counter()
+        lines: List[List[str]] = []
+        async for line in iter_document_lines(m.bot, doc.file_id):
+            row = next(csv.reader([line]), None)
+            if row and any(c.strip() for c in row):
+                lines.append([c.strip() for c in row] + [""] * (3 - len(row)))
+        if lines and lines[0][0].lstrip("@").lower() in ("usuario", "username", "user"):
+            lines = lines[1:]
+
+        ids = await db.resolve_usernames([r[0] for r in lines])
+        results = [""] * len(lines)
+        credits: List[Tuple[str, int, int]] = []
+        seen: Set[str] = set()
+        for i, (user, amount, ref) in enumerate(r[:3] for r in lines):
+            cents = money_to_cents(amount)
+            if user.lstrip("@").lower() not in ids:
+                results[i] = "usuario no encontrado"
+            elif cents is None or cents <= 0:
+                results[i] = "monto inválido"
+            elif not ref:
+                results[i] = "falta ref"
+            elif ref in seen:
+                results[i] = "ref repetida en el archivo"
+            else:
+                seen.add(ref)
+                credits.append((ref, ids[user.lstrip("@").lower()], cents))
+        applied = await db.apply_topups(m.from_user.id, credits)
+
+        out = io.StringIO()
+        writer = csv.writer(out)
+        writer.writerow(["usuario", "monto", "ref", "resultado", "saldo"])
+        total = 0
+        for (user, amount, ref), result in zip((r[:3] for r in lines), results):
+            if not result:
+                if ref in applied:
+                    result = "aplicada"
+                    total += money_to_cents(amount)
+                else:
+                    result = "ya aplicada"
+            writer.writerow([user, amount, ref, result, cents_to_money(applied[ref]) if result == "aplicada" else ""])
+        errors = sum(1 for r in results if r)
+        summary = (
+            f"✅ {len(applied)} recargas aplicadas ({cents_to_money(total)}), "
+            f"{len(credits) - len(applied)} ya aplicadas, {errors} con error, en {time.perf_counter() - t0:.2f}s"
+        )
+        outbox.edit(progress, summary)
+        outbox.document(m, BufferedInputFile(out.getvalue().encode(), filename=f"resultado_{doc.file_name}"), caption=summary)
+
+    @dp.message(F.document)
+    async def admin_document(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        pending = await db.pending_upload(m.from_user.id)
+        if not pending:
+            return
+        await ingest_document(m, pending[0])
+
+    @dp.message(F.text & ~F.text.startswith("/"))
+    async def admin_paste(m: Message):
+        if not is_admin(m.from_user.id):
+            return
+        # Plain text from an admin without an open upload is ignored (stage_codes returns None).
+        lines = [x.strip() for x in m.text.splitlines() if x.strip()]
+        if not lines:
+            return
+        staged = await db.stage_codes(m.from_user.id, lines)
+        if not staged:
+            return
+        outbox.answer(m, f"📌 Agregados {len(lines)} (pendientes totales: {staged[1]}). Escribe /done para guardar.", reply=True)
+
+    return dp
+
+
+def make_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        # Local Bot API server, or a fake one for load tests.
+        return Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(BOT_TOKEN)
+
+
+class WebhookServer:
+    # Receives updates over HTTPS (behind Railway's proxy) and runs at most max_concurrency handlers at once;
+    # when saturated, requests wait for a slot, which pushes back on Telegram instead of piling up tasks.
+    def __init__(self, bot: Bot, dp: Dispatcher, secret: str, max_concurrency: int):
+        if not secret:
+            # Admin commands trust from_user.id, so an unauthenticated endpoint would let anyone forge them.
+            raise ValueError("WebhookServer needs a secret token")
+        self.bot = bot
+        self.dp = dp
+        self.secret = secret
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.tasks: Set[asyncio.Task] = set()
+        self.accepting = True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if not hmac.compare_digest(token.encode(), self.secret.encode()):
+            return web.Response(status=401)
+        if not self.accepting:
+            return web.Response(status=503)  # Telegram retries; another replica or the next boot takes it
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        await self.slots.acquire()
+        task = asyncio.create_task(self._process(update))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception as e:
+            print(f"⚠️ Error procesando update {update.update_id}: {e}")
+        finally:
+            self.slots.release()
+
+    async def drain(self, timeout: float):
+        self.accepting = False
+        if self.tasks:
+            await asyncio.wait(set(self.tasks), timeout=timeout)
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+
+async def run_polling(bot: Bot, dp: Dispatcher, outbox: Outbox, broadcaster: Broadcaster):
+    print("✅ Polling iniciado.")
+    await bot.delete_webhook()
+    try:
+        await dp.start_polling(bot, close_bot_session=False)
+    finally:
+        await broadcaster.close()
+        await outbox.close()
+        await bot.session.close()
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher, outbox: Outbox, broadcaster: Broadcaster):
+    if not WEBHOOK_URL:
+        raise RuntimeError("Falta WEBHOOK_URL en variables de entorno (BOT_MODE=webhook).")
+    if not WEBHOOK_SECRET:
+        # Shared by every replica (each one calls set_webhook), so it cannot be generated per process.
+        raise RuntimeError("Falta WEBHOOK_SECRET en variables de entorno (BOT_MODE=webhook).")
+    server = WebhookServer(bot, dp, WEBHOOK_SECRET, WEBHOOK_MAX_CONCURRENCY)
+    runner = web.AppRunner(server.app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, PORT)
+    await site.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    await bot.set_webhook(
+        WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+        max_connections=WEBHOOK_MAX_CONCURRENCY,
+    )
+    print(f"✅ Webhook escuchando en {WEBHOOK_HOST}:{PORT}{WEBHOOK_PATH}")
+    try:
+        await stop.wait()
+    finally:
+        # The webhook stays registered: during a rolling deploy the other replica keeps receiving.
+        print("⏳ Terminando updates en curso…")
+        await server.drain(WEBHOOK_DRAIN_SECONDS)
+        await runner.cleanup()
+        await broadcaster.close()
+        await outbox.close()
+        await bot.session.close()
+
+
+def update_shard_key(update: Update) -> int:
+    user = getattr(update.event, "from_user", None)
+    if user:
+        return user.id
+    chat = getattr(update.event, "chat", None)
+    return chat.id if chat else update.update_id
+
+
+def worker_main(index: int, inbox, dsn: str):
+    # Child process entry point. Signals belong to the supervisor, which sends None when it is time to stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    asyncio.run(run_worker(index, inbox, dsn))
+
+
+async def run_worker(index: int, inbox, dsn: str):
+    db = await open_db(dsn, init=False)
+    bot = make_bot()
+    outbox = Outbox(bot, OUTBOX_RATE / WORKERS)
+    outbox.start()
+    broadcaster = Broadcaster(db, outbox)
+    broadcaster.start()
+    dp = build_dispatcher(db, outbox, broadcaster)
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(WORKER_CONCURRENCY)
+    tasks: Set[asyncio.Task] = set()
+    # One lock per user with updates in flight: a user's taps run in arrival order, different users in parallel.
+    locks: Dict[int, asyncio.Lock] = {}
+    in_flight: Dict[int, int] = {}
+
+    async def process(key: int, data: dict):
+        lock = locks.setdefault(key, asyncio.Lock())
+        in_flight[key] = in_flight.get(key, 0) + 1
+        try:
+            async with lock:
+                await dp.feed_update(bot, Update.model_validate(data, context={"bot": bot}))
+        except Exception as e:
+            print(f"⚠️ Worker {index}: error procesando update {data.get('update_id')}: {e}")
+        finally:
+            in_flight[key] -= 1
+            if not in_flight[key]:
+                del in_flight[key]
+                del locks[key]
+            slots.release()
+
+    print(f"✅ Worker {index} listo.")
+    try:
+        while True:
+            item = await loop.run_in_executor(None, inbox.get)
+            if item is None:
+                break
+            await slots.acquire()
+            task = asyncio.create_task(process(*item))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(set(tasks), timeout=WEBHOOK_DRAIN_SECONDS)
+    finally:
+        await broadcaster.close()
+        await outbox.close()
+        await bot.session.close()
+        await db.close()
+
+
+async def run_supervisor(bot: Bot, workers: int, dsn: str, allowed_updates: List[str], stop: asyncio.Event):
+    # Long-polls Telegram and hands each update to worker hash(user) % N, so every user sticks to one
+    # process (and its caches) and their updates stay ordered, while different users use all the cores.
+    ctx = mp.get_context("spawn")
+    inboxes: list = [None] * workers
+    procs: list = [None] * workers
+    spawned_at = [0.0] * workers
+    # Updates that did not fit in a worker's queue; while the worker is dead they wait here (oldest dropped
+    # when full) instead of blocking the other shards. Telegram is only told we have them once they leave
+    # this backlog (see ack below), so a shutdown or crash meanwhile gets them redelivered.
+    backlog = [deque(maxlen=WORKER_QUEUE_SIZE) for _ in range(workers)]
+    dropped = [0] * workers
+
+    def reclaim(i: int):
+        # A worker that died inside get() can leave its queue unusable: move what it never took to the backlog.
+        old, inboxes[i] = inboxes[i], None
+        try:
+            while True:
+                backlog[i].append(old.get_nowait())
+        except queue.Empty:
+            pass
+        old.cancel_join_thread()  # nobody reads it any more; do not block exit flushing it
+        old.close()
+
+    def spawn(i: int):
+        if inboxes[i] is not None:
+            reclaim(i)
+        inboxes[i] = ctx.Queue(maxsize=WORKER_QUEUE_SIZE)
+        procs[i] = ctx.Process(target=worker_main, args=(i, inboxes[i], dsn), name=f"bot-worker-{i}", daemon=True)
+        procs[i].start()
+        spawned_at[i] = time.monotonic()
+
+    def flush(i: int):
+        while backlog[i] and procs[i].is_alive():
+            try:
+                inboxes[i].put_nowait(backlog[i][0])
+            except queue.Full:
+                return
+            backlog[i].popleft()
+
+    def revive(backoff: float = WORKER_RESPAWN_SECONDS):
+        for i, p in enumerate(procs):
+            if not p.is_alive() and time.monotonic() - spawned_at[i] >= backoff:
+                print(f"⚠️ Worker {i} terminó (código {p.exitcode}), reiniciándolo… "
+                      f"({dropped[i]} updates descartados)")
+                dropped[i] = 0
+                spawn(i)
+            flush(i)
+
+    async def deliver(i: int, item):
+        flush(i)
+        while len(backlog[i]) == backlog[i].maxlen and procs[i].is_alive():
+            # That worker is alive but behind: wait for room instead of buffering without bound, checking
+            # every second that it has not died meanwhile.
+            try:
+                await loop.run_in_executor(None, lambda: inboxes[i].put(backlog[i][0], timeout=1.0))
+                backlog[i].popleft()
+            except queue.Full:
+                pass
+        dropped[i] += len(backlog[i]) == backlog[i].maxlen
+        backlog[i].append(item)
+        flush(i)
+
+    def ack() -> Optional[int]:
+        # getUpdates(offset) confirms everything below it, so stop at the oldest update still parked. While a
+        # worker is down that re-fetches what is already parked (skipped below), pausing intake until it is back.
+        parked = [b[0][1]["update_id"] for b in backlog if b]
+        return min(parked + [offset]) if offset is not None else None
+
+    for i in range(workers):
+        spawn(i)
+    loop = asyncio.get_running_loop()
+    await bot.delete_webhook()
+    print(f"✅ Supervisor: polling con {workers} workers.")
+    offset = None
     try:
-        print("✅ Polling iniciado.")
-        await dp.start_polling(bot)
+        while not stop.is_set():
+            revive()
+            poll = asyncio.create_task(bot.get_updates(offset=ack(), timeout=30, allowed_updates=allowed_updates))
+            stopped = asyncio.create_task(stop.wait())
+            done, _ = await asyncio.wait({poll, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if poll not in done:
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                print(f"⚠️ getUpdates falló: {e}")
+                await asyncio.sleep(1)
+                continue
+            fresh = [u for u in updates if offset is None or u.update_id >= offset]
+            if updates and not fresh:
+                # Only updates already parked came back: give the dead worker time instead of re-polling hot.
+                await asyncio.sleep(0.5)
+            for update in fresh:
+                key = update_shard_key(update)
+                await deliver(key % workers, (key, update.model_dump(mode="json", by_alias=True, exclude_none=True)))
+                offset = update.update_id + 1
+    finally:
+        # Hand parked updates to their workers before the sentinel, restarting dead ones right away.
+        deadline = time.monotonic() + WEBHOOK_DRAIN_SECONDS
+        revive(backoff=0)
+        while any(backlog) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+            revive()
+        for i, p in enumerate(procs):
+            if not p.is_alive():
+                reclaim(i)
+        if offset is not None:
+            # Confirm what was handed off and nothing past the first update still undelivered; Telegram
+            # sends those again to the next poller.
+            pending = sum(map(len, backlog))
+            if pending:
+                print(f"⚠️ {pending} updates sin entregar; Telegram los reenviará al próximo arranque.")
+            try:
+                await bot.get_updates(offset=ack(), limit=1, timeout=0)
+            except Exception as e:
+                print(f"⚠️ No se pudo confirmar el offset de getUpdates: {e}")
+        for inbox, p in zip(inboxes, procs):
+            if inbox is None:
+                continue
+            try:
+                await loop.run_in_executor(None, lambda: inbox.put(None, timeout=WEBHOOK_DRAIN_SECONDS))
+            except queue.Full:
+                print(f"⚠️ {p.name} no vació su cola a tiempo.")
+        for inbox, p in zip(inboxes, procs):
+            await loop.run_in_executor(None, p.join, WEBHOOK_DRAIN_SECONDS + 5)
+            if p.is_alive():
+                p.terminate()
+            if inbox is not None:
+                inbox.cancel_join_thread()  # whatever is left has no reader; do not hang exit on it
+        await bot.session.close()
+
+
+async def open_db(dsn: str, init: bool = True) -> DB:
+    pool = await asyncpg.create_pool(dsn, min_size=1, max_size=DB_POOL_SIZE, command_timeout=30)
+    db = DB(pool)
+    if init:
+        await db.init(dsn)
+    await db.start_listener(dsn)
+    db.start_background()
+    return db
+
+
+async def main():
+    if not BOT_TOKEN:
+        raise RuntimeError("Falta BOT_TOKEN en variables de entorno.")
+    if not DATABASE_URL:
+        raise RuntimeError("Falta DATABASE_URL en variables de entorno.")
+    if not ADMIN_IDS:
+        print("⚠️ ADMIN_IDS vacío. /admin no funcionará hasta que agregues ADMIN_IDS en Railway Variables.")
+
+    print("✅ Iniciando bot…")
+    print(f"✅ Admin IDs cargados: {sorted(list(ADMIN_IDS)) if ADMIN_IDS else 'NINGUNO'}")
+
+    if WORKERS > 1:
+        if BOT_MODE == "webhook":
+            raise RuntimeError("WORKERS>1 solo aplica a polling; con webhook usa varias réplicas detrás del balanceador.")
+        # The schema is set up once here, before any worker connects.
+        bot = make_bot()
+        pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=1, command_timeout=30)
+        try:
+            db = DB(pool)
+            await db.init(DATABASE_URL)
+            outbox = Outbox(bot)
+            allowed = build_dispatcher(db, outbox, Broadcaster(db, outbox)).resolve_used_update_types()
+        finally:
+            await pool.close()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await run_supervisor(bot, WORKERS, DATABASE_URL, allowed, stop)
+        return
+
+    db = await open_db(DATABASE_URL)
+    bot = make_bot()
+    outbox = Outbox(bot)
+    outbox.start()
+    broadcaster = Broadcaster(db, outbox)
+    broadcaster.start()
+    dp = build_dispatcher(db, outbox, broadcaster)
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp, outbox, broadcaster)
+        else:
+            await run_polling(bot, dp, outbox, broadcaster)
     finally:
-        await pool.close()
+        await db.close()
 
 
 if __name__ == "__main__":